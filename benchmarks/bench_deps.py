@@ -0,0 +1,98 @@
+"""Rebuild time after a source edit, with pip install in the Dockerfile or in a dependency image.
+
+Needs a running docker daemon and network access to pull the base image
+and the requirements, unlike the other benchmarks.
+
+Usage: python benchmarks/bench_deps.py [-base python:3.11-slim] [-requirements requests]
+                                        [-o results.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+
+from fakes import REPO_ROOT, make_project, temp_dir
+
+
+def write_project(root, name, base, requirements, layered):
+    """Create a project whose image installs requirements, return its folder.
+
+    A layered project lists them in the build setting, to be installed
+    in <name>:deps, the other one pip installs them after COPY . like
+    most Dockerfiles do.
+    """
+    setting = {"build_name": "bench", "docker_file": "python3", "build_cmd": "python3",
+               "run_as_module": False}
+    if layered:
+        setting.update({"requirements": ["requirements.txt"], "deps_from": base,
+                        "pip_cache": os.path.join(root, 'pip-cache')})
+    proj = make_project(os.path.join(root, name), 50, 1024, [setting])
+    with open(os.path.join(proj, 'requirements.txt'), 'w') as f:
+        f.write('\n'.join(requirements) + '\n')
+
+    if layered:
+        dockerfile = "FROM %s:deps\nCOPY . /app\n" % name
+    else:
+        dockerfile = "FROM %s\nCOPY . /app\nRUN pip install -r /app/requirements.txt\n" % base
+    with open(os.path.join(proj, 'Dockerfiles', 'python3.Dockerfile'), 'w') as f:
+        f.write(dockerfile)
+    return proj
+
+
+def build(proj):
+    """Build the image of proj with bwd, return the seconds it took."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = '%s%s%s' % (REPO_ROOT, os.pathsep, env.get('PYTHONPATH', ''))
+    env['BWD_HISTORY'] = os.path.join(os.path.dirname(proj), 'history.sqlite')
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'bwd', '-proj', proj, '-build_image', 'python3',
+                    '-build_name', 'bench'], env=env, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def time_rebuilds(base, requirements, edits=3):
+    """Time the first build, and the rebuilds after editing a source file."""
+    root = temp_dir()
+    results = {}
+    try:
+        for name, layered in (('inline', False), ('layered', True)):
+            proj = write_project(root, name, base, requirements, layered)
+            first = build(proj)
+            rebuilds = []
+            for i in range(edits):
+                with open(os.path.join(proj, 'main.py'), 'a') as f:
+                    f.write("print(%d)\n" % i)
+                rebuilds.append(build(proj))
+            results[name] = {'first_s': first, 'rebuild_s': rebuilds}
+            subprocess.call("docker rmi -f %s:python3 %s:deps" % (name, name), shell=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-base', type=str, default='python:3.11-slim', help='Image with pip')
+    parser.add_argument('-requirements', type=str, nargs='+', default=['requests'],
+                        help='Packages to install')
+    parser.add_argument('-n', type=int, default=3, help='Number of source edits')
+    parser.add_argument('-o', type=str, default=None, help='Write the results to this json file')
+    args = parser.parse_args()
+
+    results = time_rebuilds(args.base, args.requirements, args.n)
+    for name, result in sorted(results.items()):
+        print("%-8s first build %.1fs, rebuild after a source edit %.1fs (min of %d)" % (
+            name, result['first_s'], min(result['rebuild_s']), args.n))
+
+    if args.o:
+        with open(args.o, 'w') as f:
+            json.dump({'benchmark': 'deps_rebuild', 'base': args.base,
+                       'requirements': args.requirements, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Benchmarks of the bwd orchestration hot paths, on generated projects.
+
+Fake ssh, scp, unzip and docker executables are put first on PATH, so
+everything runs offline and the "remote host" is a local folder.
+
+Usage: python benchmarks/bench_hot_paths.py [-sizes small,medium] [-o results.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import contextlib
+import subprocess
+from argparse import Namespace
+
+from fakes import REPO_ROOT, make_fake_bin, make_project, temp_dir
+
+sys.path.insert(0, REPO_ROOT)
+from bwd.lib import archive, config, utils  # noqa: E402
+from bwd.lib import manifest as mf  # noqa: E402
+from bwd.lib import ssh_utils as ssh  # noqa: E402
+from bwd.lib.docker_classes import BuildWithDocker  # noqa: E402
+from bwd.lib.docker_images import DockerImages  # noqa: E402
+
+# (number of files, bytes per file)
+SIZES = {
+    'small': (100, 2 * 1024),
+    'medium': (2000, 8 * 1024),
+    'large': (10000, 32 * 1024),
+}
+SSH_USER = 'bench'
+SSH_IP = 'fakehost'
+
+
+def _timed(func, *args, **kwargs):
+    """Run func with its output hidden, return the seconds it took."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        return time.perf_counter() - start
+
+
+def _project_bytes(proj):
+    return sum(os.path.getsize(os.path.join(proj, p)) for p in mf.walk_project(proj))
+
+
+def bench_zipdir(proj, work):
+    size = _project_bytes(proj)
+    seconds = _timed(ssh.zipdir, proj, os.path.join(work, 'bench.zip'))
+    return {'seconds': seconds, 'mb_per_s': size / seconds / 1e6}
+
+
+def bench_tar_gz(proj, work):
+    size = _project_bytes(proj)
+    files = list(mf.walk_project(proj))
+
+    def consume():
+        for _ in archive.iter_tar_gz(proj, files):
+            pass
+
+    seconds = _timed(consume)
+    return {'seconds': seconds, 'mb_per_s': size / seconds / 1e6}
+
+
+def _remote_setting(proj, remote_folder, **settings):
+    """The build setting of the project, run on the fake remote."""
+    args = config.get_build_setting(
+        Namespace(proj=proj, s=os.path.join(proj, 'main.py'), build_name='bench'))
+    args.ssh_user, args.ssh_ip, args.remote_folder = SSH_USER, SSH_IP, remote_folder
+    vars(args).update(settings)
+    return args
+
+
+def bench_snapshot_send(proj, work):
+    """Send the project into a new snapshot and build there, as a "sync": "snapshot" run does."""
+    args = _remote_setting(proj, os.path.join(work, 'remote_snapshot'), sync='snapshot')
+    return {'seconds': _timed(ssh.maybe_send, args)}
+
+
+def bench_delta_sync(proj, work):
+    """Sync into one workspace: the first full sync, a no-op one and a one-file change."""
+    workspace = os.path.join(work, 'remote_workspace')
+    state = os.path.join(proj, mf.STATE_DIR)
+    if os.path.exists(state):
+        shutil.rmtree(state)
+
+    def sync():
+        remote_manifest = ssh.read_remote_manifest(SSH_USER, SSH_IP, workspace)
+        ssh.sync_project(SSH_USER, SSH_IP, proj, workspace, remote_manifest)
+
+    result = {'first_s': _timed(sync), 'unchanged_s': _timed(sync)}
+    with open(os.path.join(proj, 'main.py'), 'a') as f:
+        f.write("print('changed')\n")
+    result['one_change_s'] = _timed(sync)
+    return result
+
+
+def bench_command_generation(proj, work, iterations=200):
+    """Time the docker build and run command generation, per call."""
+    def build_commands_local():
+        for _ in range(iterations):
+            utils.get_docker_build_commands(proj)
+
+    def build_commands_remote():
+        for _ in range(iterations // 10):
+            utils.get_docker_build_commands(proj, SSH_USER, SSH_IP)
+
+    settings = Namespace(
+        v=['/data'], p=['8000:8000'], gpu=[0, 1], GUI=False, custom_cmd=None, d='python3',
+        s=os.path.join(proj, 'main.py'), run_as_module=False, build_cmd='python3', warm=False)
+
+    def run_commands():
+        for _ in range(iterations):
+            bwd = BuildWithDocker(proj)
+            bwd.add_arguments(settings)
+            bwd.get_command()
+
+    return {
+        'build_commands_local_ms': _timed(build_commands_local) / iterations * 1e3,
+        'build_commands_remote_ms': _timed(build_commands_remote) / (iterations // 10) * 1e3,
+        'run_command_ms': _timed(run_commands) / iterations * 1e3,
+    }
+
+
+def bench_build_all(proj, work, build_seconds=0.2, max_parallel=2):
+    """Schedule a diamond of images, base <- gpu, serve <- app, plus a lone one."""
+    dockerfiles = os.path.join(proj, 'Dockerfiles')
+    name = os.path.basename(proj)
+    images = {
+        'base': 'FROM python:3.6-slim',
+        'gpu': 'FROM %s:base' % name,
+        'serve': 'FROM %s:base' % name,
+        'app': 'FROM %s:serve\nCOPY main.py /app/' % name,
+        'tools': 'FROM ubuntu:18.04',
+    }
+    for image, content in images.items():
+        with open(os.path.join(dockerfiles, '%s.Dockerfile' % image), 'w') as f:
+            f.write(content + '\n')
+
+    os.environ['BWD_FAKE_BUILD_SECONDS'] = str(build_seconds)
+    try:
+        docker_images = DockerImages(proj, use_cache=False)
+        seconds = _timed(docker_images.build_all, max_parallel=max_parallel)
+    finally:
+        del os.environ['BWD_FAKE_BUILD_SECONDS']
+        for image in images:
+            os.remove(os.path.join(dockerfiles, '%s.Dockerfile' % image))
+
+    # python3.Dockerfile of the project is built as well
+    serial = (len(images) + 1) * build_seconds
+    return {'seconds': seconds, 'serial_seconds': serial, 'speedup': serial / seconds}
+
+
+BENCHMARKS = [
+    ('zipdir', bench_zipdir),
+    ('tar_gz', bench_tar_gz),
+    ('snapshot_send', bench_snapshot_send),
+    ('delta_sync', bench_delta_sync),
+    ('command_generation', bench_command_generation),
+]
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes):
+    root = temp_dir()
+    env = make_fake_bin(os.path.join(root, 'bin'))
+    os.environ.update({k: env[k] for k in ('PATH', 'BWD_SOCKET')})
+
+    results = {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'benchmarks': {},
+    }
+    try:
+        for size in sizes:
+            n_files, file_size = SIZES[size]
+            proj = make_project(os.path.join(root, size, 'proj'), n_files, file_size)
+            work = os.path.join(root, size, 'work')
+            os.makedirs(work)
+            for name, bench in BENCHMARKS:
+                result = bench(proj, work)
+                results['benchmarks'].setdefault(name, {})[size] = result
+                print("%-20s %-8s %s" % (name, size, ', '.join(
+                    '%s=%.3f' % item for item in sorted(result.items()))))
+
+        proj = make_project(os.path.join(root, 'build_all', 'proj'))
+        result = bench_build_all(proj, root)
+        results['benchmarks']['build_all'] = result
+        print("%-20s %-8s %s" % ('build_all', '-', ', '.join(
+            '%s=%.3f' % item for item in sorted(result.items()))))
+    finally:
+        shutil.rmtree(root)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '-sizes', type=str, default='small,medium',
+        help='Comma separated project sizes, out of %s' % ', '.join(SIZES))
+    parser.add_argument('-o', type=str, default=None, help='Write the results to this json file')
+    args = parser.parse_args()
+
+    results = run(args.sizes.split(','))
+    if args.o:
+        with open(args.o, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
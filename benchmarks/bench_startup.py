@@ -0,0 +1,65 @@
+"""Cold start time of a local ``bwd -s`` run, against a fake docker.
+
+Usage: python benchmarks/bench_startup.py [-n RUNS] [-o results.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import statistics
+import subprocess
+
+from fakes import make_fake_bin, make_project, temp_dir
+
+
+def time_startup(runs=20):
+    """Run ``python -m bwd -s main.py`` runs times, return the timings in seconds."""
+    root = temp_dir()
+    try:
+        env = make_fake_bin(os.path.join(root, 'bin'))
+        proj = make_project(os.path.join(root, 'proj'))
+        cmd = [sys.executable, '-m', 'bwd', '-s', os.path.join(proj, 'main.py'),
+               '-proj', proj, '-build_name', 'bench']
+
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start)
+
+        # The bare interpreter, to tell what part is bwd
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], env=env, check=True)
+        baseline = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root)
+
+    return timings, baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20, help='Number of runs')
+    parser.add_argument('-o', type=str, default=None, help='Write the results to this json file')
+    args = parser.parse_args()
+
+    timings, baseline = time_startup(args.n)
+    result = {
+        'benchmark': 'startup_local_run',
+        'runs': args.n,
+        'min_s': min(timings),
+        'median_s': statistics.median(timings),
+        'python_baseline_s': baseline,
+    }
+    print("bwd -s local run: min %.1f ms, median %.1f ms (python itself %.1f ms)" % (
+        result['min_s'] * 1e3, result['median_s'] * 1e3, baseline * 1e3))
+
+    if args.o:
+        with open(args.o, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
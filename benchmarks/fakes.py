@@ -0,0 +1,101 @@
+"""Stand-ins for the tools bwd calls, so the benchmarks run offline."""
+import os
+import json
+import getpass
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_TOOLS = {
+    # Runs the remote command locally, the "remote host" is this machine.
+    # "-O check" reports a running master, so no master is started.
+    'ssh': """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o|-O|-p|-i|-l) shift 2;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+shift
+[ $# -eq 0 ] && exit 0
+exec sh -c "$*"
+""",
+    'scp': """#!/bin/sh
+while [ $# -gt 2 ]; do shift; done
+exec cp "$1" "${2#*:}"
+""",
+    'unzip': """#!/usr/bin/env python3
+import sys, zipfile
+args = [a for a in sys.argv[1:] if a not in ('-o', '-q')]
+dest = args[args.index('-d') + 1] if '-d' in args else '.'
+zipfile.ZipFile(args[0]).extractall(dest)
+""",
+    # $BWD_FAKE_GPUS idle GPUs
+    'nvidia-smi': """#!/bin/sh
+i=0
+while [ $i -lt ${BWD_FAKE_GPUS:-4} ]; do echo "$i, 0"; i=$((i + 1)); done
+""",
+    # Images never exist, a build consumes its context and takes
+    # $BWD_FAKE_BUILD_SECONDS
+    'docker': """#!/bin/sh
+[ "$1" = image ] && exit 1
+if [ "$1" = build ]; then
+    cat > /dev/null
+    sleep ${BWD_FAKE_BUILD_SECONDS:-0}
+fi
+exit 0
+""",
+}
+
+
+def make_fake_bin(folder, tools=None):
+    """Write fake executables into folder, return an env with them first on PATH."""
+    os.makedirs(folder, exist_ok=True)
+    for name, script in (tools or FAKE_TOOLS).items():
+        path = os.path.join(folder, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+    env = dict(os.environ)
+    env['PATH'] = '%s%s%s' % (folder, os.pathsep, env.get('PATH', ''))
+    env['PYTHONPATH'] = '%s%s%s' % (REPO_ROOT, os.pathsep, env.get('PYTHONPATH', ''))
+    # Never talk to a real daemon of the user
+    env['BWD_SOCKET'] = os.path.join(folder, 'no-daemon.sock')
+    # Record in a history of its own, so its cost is measured without
+    # touching the history of the user
+    env['BWD_HISTORY'] = os.path.join(folder, 'history.sqlite')
+    return env
+
+
+def make_project(root, n_files=10, file_size=1024, build_settings=None):
+    """Create a bwd project with n_files python files of file_size bytes."""
+    os.makedirs(os.path.join(root, 'Dockerfiles'), exist_ok=True)
+    with open(os.path.join(root, 'Dockerfiles', 'python3.Dockerfile'), 'w') as f:
+        f.write("FROM python:3.6-slim\nCOPY . /app\n")
+
+    settings = build_settings or [{
+        "build_name": "bench",
+        "docker_file": "python3",
+        "build_cmd": "python3",
+        "run_as_module": False
+    }]
+    with open(os.path.join(root, 'bwd.json'), 'w') as f:
+        json.dump({getpass.getuser(): settings}, f)
+
+    line = b"x = 1  # benchmark filler\n"
+    content = (line * (file_size // len(line) + 1))[:file_size]
+    for i in range(n_files):
+        folder = os.path.join(root, 'pkg%d' % (i % 10))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'mod%d.py' % i), 'wb') as f:
+            f.write(content)
+
+    with open(os.path.join(root, 'main.py'), 'w') as f:
+        f.write("print('hello')\n")
+    return root
+
+
+def temp_dir():
+    return tempfile.mkdtemp(prefix='bwd-bench-')
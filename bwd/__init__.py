@@ -2,8 +2,9 @@
 from __future__ import absolute_import
 
 
-def main():
-    import bwd.bwd
+def main(argv=None):
+    from .bwd import main as run
+    return run(argv)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,106 +1,25 @@
 import argparse
-from argparse import Namespace
+import importlib
 import os
-import json
-import getpass
-import sys
 
-from lib.docker_classes import BuildWithDocker, DockerImages
-from lib import ssh_utils as ssh
-from lib import utils
 
-# Make all print statements RED until we run the actual build command
-utils.set_color('RED')
+def _lib(name):
+    """Import a module of bwd.lib the first time a path needs it.
 
-def check_for_cfg(project_dir):
-    return os.path.exists(os.path.join(project_dir, "bwd.json"))
-
-
-def parse_cfg_file(project_dir):
-    file = os.path.join(project_dir, "bwd.json")
-    with open(file, 'r') as f:
-        cfg = json.load(f)
-
-    # Add user
-    for user in cfg:
-        for build in cfg[user]:
-            build["user"] = user
-
-    # Fetch the current user
-    current_user = getpass.getuser()
-
-    # Check for these fields
-    check_these = [current_user, "common"]
-
-    # Fetch the configs
-    build_settings = []
-    for iCheck in check_these:
-        if iCheck in cfg:
-            build_settings += cfg[iCheck]
-
-    # Make sure it has build_cmd specified, if not
-    # issue a warning.
-    for i, i_setting in enumerate(build_settings):
-        if "build_cmd" not in i_setting:
-            print("Warning, build_cmd for %s / common not found" % current_user)
-        if "build_name" not in i_setting:
-            set_name = "%s_%d" % (i_setting["user"], i)
-            print("Warning, build_name for %s / common not found" % current_user)
-            print("Generated build name is %s" % set_name)
-            i_setting["build_name"] = set_name
-
-
-    build_names = [i_setting['build_name'] for i_setting in build_settings]
-    return build_settings, build_names
-
-
-def get_build_setting(args):
-    # Make sure that we are using absolute paths
-    args.proj = os.path.abspath(args.proj)
-    args.s = os.path.abspath(args.s)
-
-    build_settings, build_names = parse_cfg_file(args.proj)
-
-    # Check build
-    nr = 0
-    if args.build_name is not None:
-        if args.build_name in build_names:
-            nr = build_names.index(args.build_name)
-        else:
-            print("Could not find %s in build config." % args.build_name)
-            print("Using the first build settings as default.")
-    else:
-        print("No build name specified, using %s as default" % build_settings[nr]['build_name'])
-
-
-    def get_namespace(**kwargs):
-        param = {
-            'proj': args.proj,
-            's': args.s,
-            'd': kwargs.get('docker_file', None),
-            'v': kwargs.get('volumes', None),
-            'p': kwargs.get('ports', None),
-            'gpu': kwargs.get('gpu', None),
-            'GUI': kwargs.get('GUI', None),
-            'ssh_ip': kwargs.get('ssh_ip', None),
-            'ssh_user': kwargs.get('ssh_user', None),
-            'remote_folder': kwargs.get('remote_folder', None),
-            'run_as_module': kwargs.get('run_as_module', False),
-            'build_cmd': kwargs.get('build_cmd', None),
-            'custom_cmd': kwargs.get('custom_cmd', None),
-            'disable_docker': kwargs.get('disable_docker', False),
-        }
-
-        return Namespace(**param)
-
-    return get_namespace(**build_settings[nr])
+    Also works when this file is run as a script, python3 bwd/bwd.py
+    """
+    package = '%s.lib' % __package__ if __package__ else 'lib'
+    return importlib.import_module('%s.%s' % (package, name))
 
 
 def init_project(project_dir):
+    import json
+    import getpass
+
     print("Initializing project..")
     docker_folder = os.path.join(project_dir, 'Dockerfiles')
 
-    if check_for_cfg(project_dir) or os.path.exists(docker_folder):
+    if _lib('config').check_for_cfg(project_dir) or os.path.exists(docker_folder):
         print("\tbwd.json and/or Dockerfiles folder already present in the project! Delete the bwd.json and the Dockefiles folder")
         exit()
 
@@ -154,108 +73,298 @@ def init_project(project_dir):
 
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    '-s',
-    help='Python script to build',
-    type=str
-)
-parser.add_argument(
-    '-proj',
-    help='Project directory',
-    type=str
-)
-parser.add_argument(
-    '-build_name',
-    help='Which build setting from "common" or "$USER" to build with. Default is first one from user.',
-    type=str,
-    default=''
-)
-parser.add_argument(
-    '-build_image',
-    help='Build the projects docker images, supply "all" as parameter to build all images',
-    type=str,
-    const='all',
-    default=None,
-    action='store',
-    nargs='?',
-)
-parser.add_argument(
-    '-init',
-    help='Initialize the project by creating a build config file and a Dockerfile.',
-    type=str,
-    const='',
-    default=None,
-    action='store',
-    nargs='?',
-)
-args = parser.parse_args()
-
-
-# Make sure that either -s or -build_images is provided
-if args.s is None and args.build_image is None and args.init is None:
-    parser.error("Could not determine what to do. Make sure that you either provide this with -s or -build_image")
-
-# If project dir is not specified, assume its the cwd<
-if args.proj is None:
-    args.proj = os.getcwd()
-    print("No project specified, assuming %s is project root" % args.proj)
-
-
-if args.init is not None:
-    # User wants to initialize the project
-    init_project(args.proj)
-    exit()
-
-# Check for a config file
-if not check_for_cfg(args.proj):
-    parser.error("Could not find a config file in root directory!")
-
-# Build
-if args.build_image is not None:
-    docker_images = DockerImages(args.proj)
-    utils.set_color('RESET')
-    if args.build_image == 'all':
-        print("No specific Dockerfile mentioned, building all files..")
-        docker_images.build_all()
-        print("Finished building all docker images")
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-s',
+        help='Python script to build',
+        type=str
+    )
+    parser.add_argument(
+        '-proj',
+        help='Project directory',
+        type=str
+    )
+    parser.add_argument(
+        '-build_name',
+        help='Which build setting from "common" or "$USER" to build with. Default is first one from user.',
+        type=str,
+        default=''
+    )
+    parser.add_argument(
+        '-build_image',
+        help='Build the projects docker images, supply "all" as parameter to build all images',
+        type=str,
+        const='all',
+        default=None,
+        action='store',
+        nargs='?',
+    )
+    parser.add_argument(
+        '-build_jobs',
+        help='How many docker images -build_image may build at the same time.',
+        type=int,
+        default=2
+    )
+    parser.add_argument(
+        '-no_build_cache',
+        help='Build the docker images even if they are up to date.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-daemon',
+        help='Run the bwd daemon, which keeps configs and commands in memory for faster runs.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-init',
+        help='Initialize the project by creating a build config file and a Dockerfile.',
+        type=str,
+        const='',
+        default=None,
+        action='store',
+        nargs='?',
+    )
+    parser.add_argument(
+        '-jobs',
+        help='Run every script of this file, one per line with its arguments, each on a free GPU of the gpu list.',
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        '-batch',
+        help='Run these scripts, or glob patterns of scripts, in one container, see batch_workers and batch_containers.',
+        type=str,
+        nargs='+',
+        default=None,
+    )
+    parser.add_argument(
+        '-watch',
+        help='Run the script again every time a file of the project changes, sending only the changed files.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-stats',
+        help='Show the percentiles of the recorded runs of the last this many days (30 by default), and flag the phases that got slower.',
+        type=int,
+        const=30,
+        default=None,
+        action='store',
+        nargs='?',
+    )
+    parser.add_argument(
+        '-trace',
+        help='Print how long each phase of the run took. Given a path, write a Chrome trace json there instead.',
+        type=str,
+        const='',
+        default=None,
+        action='store',
+        nargs='?',
+    )
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    trace = _lib('trace')
+    history = _lib('history')
+    exit_code = 1
+    try:
+        with trace.span('bwd', mode=history.get_mode(args)):
+            run(parser, args)
+        exit_code = 0
+    except KeyboardInterrupt:
+        exit_code = 130
+        raise
+    except Exception as e:
+        exit_code = getattr(e, 'returncode', 1)
+        raise
+    finally:
+        if args.trace == '':
+            print(trace.get_tracer().summary())
+        elif args.trace is not None:
+            trace.get_tracer().write(args.trace)
+            print("Wrote the trace of this run to %s" % args.trace)
+        # Every run is kept, see -stats
+        history.record(trace.get_tracer(), exit_code)
+
+
+def run(parser, args):
+    utils = _lib('utils')
+    trace = _lib('trace')
+    config = _lib('config')
+
+    # Make all print statements RED until we run the actual build command
+    utils.set_color('RED')
+
+    if args.daemon:
+        utils.set_color('RESET')
+        _lib('daemon').serve()
+        return
+
+    if args.stats is not None:
+        utils.set_color('RESET')
+        print(_lib('history').stats(args.stats, args.proj, args.build_name or None))
+        return
+
+    # Make sure that either -s or -build_images is provided
+    if args.s is None and args.build_image is None and args.init is None \
+            and args.jobs is None and args.batch is None:
+        parser.error("Could not determine what to do. Make sure that you either provide this with -s or -build_image")
+
+    # If project dir is not specified, assume its the cwd<
+    if args.proj is None:
+        args.proj = os.getcwd()
+        print("No project specified, assuming %s is project root" % args.proj)
+
+    if args.init is not None:
+        # User wants to initialize the project
+        init_project(args.proj)
+        return
+
+    # Check for a config file
+    if not config.check_for_cfg(args.proj):
+        parser.error("Could not find a config file in root directory!")
+
+    # Build
+    if args.build_image is not None:
+        trace.add(build_image=args.build_image, project=os.path.abspath(args.proj),
+                  build_name=args.build_name, image=None)
+        # Only a build setting with "requirements" is resolved, for its
+        # dependency image, other builds only need the Dockerfiles
+        deps = None
+        if config.lists_requirements(args.proj, args.build_name):
+            setting = argparse.Namespace(**vars(args))
+            setting.s = args.proj
+            setting = _lib('daemon').get_build_setting(setting)
+            trace.add(**_lib('history').describe(setting))
+            deps = _lib('deps').from_args(setting, remote=False)
+        docker_images = _lib('docker_images').DockerImages(
+            args.proj, use_cache=not args.no_build_cache,
+            dockerfiles=_lib('daemon').get_dockerfiles(args.proj), deps=deps)
+        utils.set_color('RESET')
+        if args.build_image == 'all':
+            print("No specific Dockerfile mentioned, building all files..")
+            docker_images.build_all(max_parallel=args.build_jobs)
+            print("Finished building all docker images")
+        else:
+            print("Building %s.." % args.build_image)
+            docker_images.build_one(args.build_image, max_parallel=args.build_jobs)
+            print("Finished building %s docker image" % args.build_image)
+
+    # The build setting is the one of the first job
+    jobs = None
+    if args.jobs is not None:
+        jobs = _lib('jobs').read_jobs(args.jobs)
+        if not jobs:
+            parser.error("No jobs found in %s" % args.jobs)
+        args.s = jobs[0].script
+
+    # The build setting is the one of the first script of the batch
+    batch = None
+    if args.batch is not None:
+        batch = _lib('batch').expand_scripts(args.batch)
+        if not batch:
+            parser.error("No scripts match %s" % ' '.join(args.batch))
+        args.s = batch[0]
+
+    # If no s argument is specified and we reach this spot, exit
+    if args.s is None:
+        return
+
+    watch = args.watch
+    if watch and (jobs is not None or batch is not None):
+        parser.error("-watch reruns one script, it does not combine with -jobs or -batch")
+
+    # Otherwise, we load in the config file
+    daemon = _lib('daemon')
+    with trace.span('config'):
+        args = daemon.get_build_setting(args)
+    trace.add(**_lib('history').describe(args))
+
+    # The same build setting may run on several hosts at the same time
+    ssh_result = None
+    if config.is_remote(args):
+        fanout = _lib('fanout')
+        ssh = _lib('ssh_utils')
+        hosts = fanout.get_hosts(args)
+        if len(hosts) > 1 and (jobs is not None or batch is not None or watch):
+            parser.error("-jobs, -batch and -watch run on one host, the build setting has %d"
+                         % len(hosts))
+        if len(hosts) > 1:
+            utils.set_color('RESET')
+            if args.outputs:
+                print("Outputs are only fetched from runs on one host, they stay on the hosts")
+            try:
+                fanout.run_on_hosts(args, hosts)
+            finally:
+                print(ssh.connection_report())
+            return
+        args.ssh_user, args.ssh_ip = hosts[0]
+        trace.add(host=args.ssh_ip)
+
+        # Send the project through a tunnel, then build
+        with trace.span('remote'):
+            ssh_result = ssh.maybe_send(args)
+
+    # Outputs of remote runs are fetched during and after them
+    def fetching():
+        if args.outputs and ssh_result is not None:
+            return _lib('outputs').fetching(args, ssh_result)
+        import contextlib
+        return contextlib.nullcontext()
+
+    # Run a queue of jobs, each on a free GPU
+    if jobs is not None:
+        utils.set_color('RESET')
+        with trace.span('jobs', jobs=len(jobs)), fetching():
+            _lib('jobs').GpuScheduler(args, ssh_result).run(jobs)
+        if ssh_result is not None:
+            print(ssh.connection_report())
+        return
+
+    # Run many scripts in a few containers
+    if batch is not None:
+        utils.set_color('RESET')
+        with trace.span('batch', scripts=len(batch)), fetching():
+            _lib('batch').run_batch(args, batch, ssh_result)
+        if ssh_result is not None:
+            print(ssh.connection_report())
+        return
+
+    # Run again on every change of the project
+    if watch:
+        utils.set_color('RESET')
+        with fetching():
+            _lib('watch').Watcher(args, ssh_result).run()
+        if ssh_result is not None:
+            print(ssh.connection_report())
+        return
+
+    if ssh_result is not None:
+        command = fanout.get_run_command(args, ssh_result)
     else:
-        print("Building %s.." % args.build_image)
-        docker_images.build_one(args.build_image)
-        print("Finished building %s docker image" % args.build_image)
-
-
-# If no s argument is specified and we reach this spot, exit
-if args.s is None:
-    exit()
-
-# Otherwise, we load in the config file
-args = get_build_setting(args)
-
-# Maybe send the project through a tunnel, then build
-ssh_result = ssh.maybe_send(args)
-
-# Get the docker builder class
-bwd = BuildWithDocker(args.proj, ssh_result)
-# Pass it our arguments
-bwd.add_arguments(args)
-
-# Get the command
-command = bwd.get_command()
+        with trace.span('command'):
+            command = daemon.get_command(args, ssh_result)
+        if args.disable_docker:
+            print("Removing docker related commands")
+            print(command)
+            command = utils.remove_docker_cmd(command, args, ssh_result)
+            print(command)
+
+    # Run
+    utils.set_color('GREEN')
+    print("Docker command:\n\t--> %s" % command)
+    utils.set_color('RESET')
+    with trace.span('run', image=args.d, warm=args.warm), fetching():
+        status = os.system(command)
+    trace.add(exit_code=_lib('history').exit_code(status))
 
-# If disable docker, remove any docker related commands
-if args.disable_docker:
-    print("Removing docker related commands")
-    print(command)
-    command = utils.remove_docker_cmd(command, args, ssh_result)
-    print(command)
+    # Tell how much the shared ssh connection saved
+    if ssh_result is not None:
+        print(ssh.connection_report())
 
-# Append ssh command if needed
-if ssh_result is not None:
-    command = ssh.append_ssh(args.ssh_user, args.ssh_ip, command)
 
-# Run
-utils.set_color('GREEN')
-print("Docker command:\n\t--> %s" % command)
-utils.set_color('RESET')
-os.system(command)
+if __name__ == '__main__':
+    main()
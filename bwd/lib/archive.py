@@ -0,0 +1,179 @@
+import io
+import os
+import mmap
+import zlib
+import tarfile
+import collections
+import multiprocessing
+
+# Files with these endings are already compressed, they are stored as is
+STORED_EXTENSIONS = (
+    '.npz', '.npy.gz', '.png', '.jpg', '.jpeg', '.gif', '.mp4', '.avi',
+    '.gz', '.tgz', '.bz2', '.xz', '.zip', '.7z', '.whl', '.egg',
+    '.h5', '.hdf5', '.pt', '.pth', '.ckpt', '.pb', '.tflite', '.onnx',
+)
+DEFAULT_LEVEL = 6
+STORED_LEVEL = 0
+
+# Large files are split into chunks so they can be compressed in parallel
+CHUNK_SIZE = 16 << 20
+# Below this many bytes the pool costs more than it saves
+PARALLEL_THRESHOLD = 4 << 20
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def compression_level(path):
+    """Return the gzip level to use for the file at path."""
+    if path.lower().endswith(STORED_EXTENSIONS):
+        return STORED_LEVEL
+    return DEFAULT_LEVEL
+
+
+def _read_piece(compressor, path, offset, length):
+    """Compress length bytes of path from offset, read through a memory map."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        available = max(min(length, size - offset), 0)
+        if available:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    out = compressor.compress(view[offset:offset + available])
+                finally:
+                    view.release()
+        else:
+            out = b''
+    # The file shrank since its header was written, keep the tar valid
+    if available < length:
+        out += compressor.compress(b'\0' * (length - available))
+    return out
+
+
+def _compress_chunk(task):
+    """Compress one chunk of the tar stream into a standalone gzip member.
+
+    Parameters
+    ----------
+    task : tuple
+        (level, pieces), each piece is a (prefix, path, offset, length,
+        suffix) tuple standing for the prefix bytes, length bytes of path
+        starting at offset, and the suffix bytes. path is None for
+        pieces without file data.
+
+    Returns
+    -------
+    bytes
+        The gzip member
+    """
+    level, pieces = task
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    parts = []
+    for prefix, path, offset, length, suffix in pieces:
+        parts.append(compressor.compress(prefix))
+        if path is not None and length:
+            parts.append(_read_piece(compressor, path, offset, length))
+        parts.append(compressor.compress(suffix))
+    parts.append(compressor.flush())
+    return b''.join(parts)
+
+
+def _tar_pieces(proj_root, files, chunk_size):
+    """Yield (level, piece) for the tar stream of files, in order."""
+    # Only used to create headers, it keeps track of hard links
+    tar = tarfile.TarFile(fileobj=io.BytesIO(), mode='w', format=tarfile.PAX_FORMAT)
+    for rel_path in files:
+        full_path = os.path.join(proj_root, rel_path)
+        try:
+            info = tar.gettarinfo(full_path, rel_path)
+        except OSError:
+            # Removed while walking
+            continue
+        header = info.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape')
+        level = compression_level(rel_path)
+        if not info.isreg() or info.size == 0:
+            yield level, (header, None, 0, 0, b'')
+            continue
+
+        padding = b'\0' * (-info.size % BLOCK_SIZE)
+        offsets = range(0, info.size, chunk_size)
+        for i, offset in enumerate(offsets):
+            length = min(chunk_size, info.size - offset)
+            prefix = header if i == 0 else b''
+            suffix = padding if i == len(offsets) - 1 else b''
+            yield level, (prefix, full_path, offset, length, suffix)
+
+    # End of archive marker
+    yield DEFAULT_LEVEL, (b'\0' * (2 * BLOCK_SIZE), None, 0, 0, b'')
+
+
+def _tar_tasks(proj_root, files, chunk_size=CHUNK_SIZE):
+    """Group the tar stream of files into compression tasks, in order.
+
+    Consecutive small files that use the same level share one task.
+    """
+    pieces = []
+    task_level = None
+    task_size = 0
+    for level, piece in _tar_pieces(proj_root, files, chunk_size):
+        if pieces and (level != task_level or task_size >= chunk_size):
+            yield task_level, pieces
+            pieces, task_size = [], 0
+        task_level = level
+        pieces.append(piece)
+        task_size += len(piece[0]) + piece[3]
+    if pieces:
+        yield task_level, pieces
+
+
+def iter_tar_gz(proj_root, files, processes=None):
+    """Yield a gzipped tar of some project files, compressed in parallel.
+
+    Every piece of the tar is compressed into its own gzip member by a
+    process pool, the members are yielded in order. Concatenated they
+    form a valid .tar.gz, so ``tar -xzf`` extracts it as usual.
+
+    Parameters
+    ----------
+    proj_root : str
+        Folder the files are relative to
+    files : list
+        Paths, relative to proj_root, to put in the archive
+    processes : int, optional
+        Size of the process pool, defaults to the number of cores.
+        Small archives are always compressed in this process.
+
+    Yields
+    ------
+    bytes
+        The next part of the archive
+    """
+    processes = processes or os.cpu_count() or 1
+    tasks = _tar_tasks(proj_root, files)
+
+    total_size = 0
+    for rel_path in files:
+        try:
+            total_size += os.lstat(os.path.join(proj_root, rel_path)).st_size
+        except OSError:
+            pass
+
+    if processes == 1 or total_size < PARALLEL_THRESHOLD:
+        for task in tasks:
+            yield _compress_chunk(task)
+        return
+
+    # This runs in the thread that feeds a command, forking a process
+    # with threads can deadlock, so the workers start from a fresh one
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    # Keep a bounded number of chunks in flight, so a slow receiver
+    # does not make the whole compressed project pile up in memory.
+    with context.Pool(processes) as pool:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_compress_chunk, (task,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -0,0 +1,118 @@
+import os
+import copy
+import glob
+import json
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+
+from . import custom_exceptions as ce
+from . import daemon
+from . import trace
+from . import utils
+from .batch_runner import MARKER
+
+
+def expand_scripts(patterns):
+    """Return the scripts the paths and glob patterns match, each once, in order."""
+    scripts = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            match = os.path.abspath(match)
+            if match not in scripts:
+                scripts.append(match)
+    return scripts
+
+
+def get_command(args, ssh_result):
+    """Return the shell command that starts one batch container of args."""
+    command = daemon.get_command(args, ssh_result)
+    if ssh_result is not None:
+        from .ssh_utils import append_ssh
+        command = append_ssh(args.ssh_user, args.ssh_ip, shlex.quote(command))
+    return "sh -c %s" % shlex.quote(command)
+
+
+def _parse_results(lines, targets):
+    """Collect the result the runner printed for each of its targets.
+
+    Targets without a result, because the runner did not get there or
+    its line could not be read, get a None returncode.
+    """
+    found = {}
+    for line in lines:
+        if not line.startswith(MARKER):
+            continue
+        try:
+            result = json.loads(line[len(MARKER):])
+        except ValueError:
+            continue
+        found[result['script']] = result
+    return [found.get(target, {'script': target, 'returncode': None, 'seconds': 0.})
+            for target in targets]
+
+
+def run_batch(args, scripts, ssh_result=None):
+    """Run every script in a small pool of containers, several at a time in each.
+
+    The scripts are split over "batch_containers" containers, each runs
+    "batch_workers" of them at the same time, see batch_runner.
+
+    Parameters
+    ----------
+    args : Namespace
+        The build setting, see config.get_build_setting
+    scripts : list
+        Full paths of the scripts, see expand_scripts
+    ssh_result : str, optional
+        The folder the project was sent to, if it runs on a remote
+
+    Returns
+    -------
+    list
+        A dict with the script, returncode and seconds of every script
+
+    Raises
+    ------
+    ce.JobsFailed
+        Some scripts exited with an error
+    """
+    n_containers = max(min(args.batch_containers, len(scripts)), 1)
+    groups = [scripts[i::n_containers] for i in range(n_containers)]
+
+    @utils.in_caller_context
+    def run_container(index):
+        group_args = copy.copy(args)
+        group_args.batch = groups[index]
+        group_args.batch_index = index if n_containers > 1 else None
+        prefix = '[batch %d] ' % index if n_containers > 1 else ''
+        # The names the runner gives the scripts, see add_batch
+        if args.run_as_module:
+            targets = [utils.get_module_path(args.proj, s) for s in groups[index]]
+        else:
+            targets = [os.path.relpath(s, args.proj) for s in groups[index]]
+        # The tail has to hold the result line of every script
+        tail_lines = len(targets) + utils.TAIL_LINES
+        with trace.span('batch', scripts=len(groups[index])):
+            try:
+                output = utils.run_and_stream(
+                    get_command(group_args, ssh_result), prefix=prefix, tail_lines=tail_lines)
+                return _parse_results(output.splitlines(), targets)
+            except ce.CommandFailed as e:
+                return _parse_results(e.tail, targets)
+
+    print("Running %d scripts in %d containers, %d at a time in each" % (
+        len(scripts), n_containers, args.batch_workers))
+    with ThreadPoolExecutor(max_workers=n_containers) as executor:
+        results = [r for group in executor.map(run_container, range(n_containers)) for r in group]
+
+    print("Batch summary:")
+    for result in results:
+        status = 'exit %d' % result['returncode'] if result['returncode'] is not None \
+            else 'not run'
+        print("\t%-50s %-8s %7.1fs" % (result['script'], status, result['seconds']))
+
+    failed = [result['script'] for result in results if result['returncode'] != 0]
+    if failed:
+        raise ce.JobsFailed(failed)
+    return results
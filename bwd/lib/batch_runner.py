@@ -0,0 +1,112 @@
+"""Runs many python scripts in one interpreter, inside the container.
+
+bwd starts it as ``python -c <this file> <workers> [-m] <script>...``.
+Every script runs in a process forked from this one, at most workers
+at the same time, so no interpreter has to start up for it. Its output
+is printed line by line with the script in front. The exit code and
+duration of every script are printed last, one line of json after
+MARKER per script, so no line gets long.
+
+Only the standard library is used, it runs on the python of the image.
+"""
+import os
+import sys
+import json
+import time
+import runpy
+import select
+
+MARKER = '@@bwd-batch '
+
+
+def run_one(target, as_module):
+    """Run a script or module as __main__, return its exit code."""
+    sys.argv = [target]
+    try:
+        if as_module:
+            runpy.run_module(target, run_name='__main__', alter_sys=True)
+        else:
+            sys.path[0] = os.path.dirname(os.path.abspath(target))
+            runpy.run_path(target, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        sys.stderr.write('%s\n' % e.code)
+        return 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def start(target, as_module):
+    """Fork a process that runs target, return its pid and output pipe."""
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        code = run_one(target, as_module)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code & 0xff)
+    os.close(write_fd)
+    return pid, read_fd
+
+
+def _write(target, line):
+    os.write(1, b'[' + target.encode() + b'] ' + line + b'\n')
+
+
+def main(argv):
+    workers = int(argv[0])
+    as_module = len(argv) > 1 and argv[1] == '-m'
+    queue = list(argv[2:] if as_module else argv[1:])
+
+    # Output pipe of each running script: target, pid, start, partial line
+    running = {}
+    results = []
+    while queue or running:
+        while queue and len(running) < workers:
+            target = queue.pop(0)
+            pid, fd = start(target, as_module)
+            running[fd] = [target, pid, time.time(), b'']
+
+        ready, _, _ = select.select(list(running), [], [])
+        for fd in ready:
+            entry = running[fd]
+            data = os.read(fd, 65536)
+            if data:
+                lines = (entry[3] + data).split(b'\n')
+                entry[3] = lines.pop()
+                for line in lines:
+                    _write(entry[0], line)
+                continue
+
+            if entry[3]:
+                _write(entry[0], entry[3])
+            os.close(fd)
+            del running[fd]
+            _, status = os.waitpid(entry[1], 0)
+            if os.WIFEXITED(status):
+                returncode = os.WEXITSTATUS(status)
+            else:
+                returncode = -os.WTERMSIG(status)
+            results.append({
+                'script': entry[0],
+                'returncode': returncode,
+                'seconds': time.time() - entry[2],
+            })
+
+    for result in results:
+        os.write(1, (MARKER + json.dumps(result) + '\n').encode())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
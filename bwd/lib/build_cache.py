@@ -0,0 +1,213 @@
+import os
+import json
+import shlex
+import fnmatch
+import hashlib
+import threading
+import subprocess
+
+from . import manifest as mf
+from . import probe
+from .ssh_utils import append_ssh, read_remote_json, write_remote_json
+
+CACHE_NAME = 'build_cache.json'
+
+
+def _logical_lines(text):
+    """Join the continued lines of a Dockerfile, drop comments."""
+    lines = []
+    current = ''
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('#') and not current:
+            continue
+        if stripped.endswith('\\'):
+            current += stripped[:-1] + ' '
+            continue
+        current += stripped
+        if current:
+            lines.append(current)
+        current = ''
+    if current:
+        lines.append(current)
+    return lines
+
+
+def parse_dockerfile(text):
+    """Find what a Dockerfile builds from.
+
+    Parameters
+    ----------
+    text : str
+        Content of the Dockerfile
+
+    Returns
+    -------
+    tuple
+        (base_images, sources), the images named in FROM and the context
+        paths or urls used by COPY/ADD. Earlier build stages and COPY
+        --from sources are left out.
+    """
+    base_images = []
+    stages = set()
+    sources = []
+    for line in _logical_lines(text):
+        instruction, _, rest = line.partition(' ')
+        instruction = instruction.upper()
+        if instruction == 'FROM':
+            words = [w for w in rest.split() if not w.startswith('--')]
+            if words and words[0].lower() not in stages:
+                base_images.append(words[0])
+            if len(words) == 3 and words[1].upper() == 'AS':
+                stages.add(words[2].lower())
+        elif instruction in ('COPY', 'ADD'):
+            rest = rest.strip()
+            if rest.startswith('['):
+                try:
+                    words = json.loads(rest)
+                except ValueError:
+                    words = shlex.split(rest)
+            else:
+                words = rest.split()
+            if any(w.startswith('--from') for w in words):
+                continue
+            words = [w for w in words if not w.startswith('--')]
+            sources += words[:-1]
+
+    return base_images, sources
+
+
+def match_sources(sources, files):
+    """Return the files, relative to the context, that sources cover."""
+    matched = set()
+    for source in sources:
+        if '://' in source:
+            continue
+        source = os.path.normpath(source.lstrip('/'))
+        if source == '.':
+            return set(files)
+        prefix = source + '/'
+        for rel_path in files:
+            if rel_path == source or rel_path.startswith(prefix) \
+                    or fnmatch.fnmatchcase(rel_path, source):
+                matched.add(rel_path)
+    return matched
+
+
+def inspect_image(image, ssh_user=None, ssh_ip=None):
+    """Return the id of image on the (remote) docker daemon, None if missing.
+
+    Remote images the probe of this run knows are not asked for again.
+    """
+    cmd = "docker image inspect --format '{{.Id}}' %s" % image
+    if ssh_ip is not None:
+        known, image_id = probe.image_id(ssh_user, ssh_ip, image)
+        if known:
+            return image_id
+        cmd = append_ssh(ssh_user, ssh_ip, '"%s"' % cmd)
+    try:
+        response = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    return response.decode().strip() or None
+
+
+def fingerprint(source_dir, dockerfile, ignore=None, ssh_user=None, ssh_ip=None):
+    """Fingerprint everything a docker build depends on.
+
+    Parameters
+    ----------
+    source_dir : str
+        Local copy of the build context
+    dockerfile : str
+        Path of the Dockerfile, relative to source_dir
+    ignore : IgnoreFilter, optional
+        Files that are not part of the build context
+    ssh_user : None, optional
+        User name of the remote-host machine that builds
+    ssh_ip : None, optional
+        IP address of the remote-host machine that builds
+
+    Returns
+    -------
+    str
+        sha1 of the Dockerfile, the COPY/ADD files and the base image ids
+    """
+    with open(os.path.join(source_dir, dockerfile), 'rb') as f:
+        content = f.read()
+    base_images, sources = parse_dockerfile(content.decode('utf-8', 'replace'))
+
+    sha = hashlib.sha1(content)
+    for image in base_images:
+        sha.update(('\0%s=%s' % (image, inspect_image(image, ssh_user, ssh_ip))).encode())
+
+    if sources:
+        # Reuse the hashes of the sync manifest for unchanged files
+        manifest_path = mf.local_manifest_path(source_dir)
+        manifest = mf.build_manifest(
+            source_dir, previous=mf.load_manifest(manifest_path), ignore=ignore)
+        mf.save_manifest(manifest_path, manifest)
+        for source in sources:
+            sha.update(('\0%s' % source).encode())
+        for rel_path in sorted(match_sources(sources, manifest)):
+            sha.update(('\0%s=%s' % (rel_path, manifest[rel_path][2])).encode())
+
+    return sha.hexdigest()
+
+
+class BuildCache():
+    """Remembers the fingerprint each image tag was last built from."""
+    def __init__(self, cache_dir, ssh_user=None, ssh_ip=None):
+        """Initialize class
+
+        Parameters
+        ----------
+        cache_dir : str
+            Folder of the cache file, on the remote host for remote builds
+        ssh_user : None, optional
+            User name of the remote-host machine
+        ssh_ip : None, optional
+            IP address of the remote-host machine
+
+        """
+        self._path = os.path.join(cache_dir, CACHE_NAME)
+        self._ssh_user = ssh_user
+        self._ssh_ip = ssh_ip
+        self._entries = None
+        self._lock = threading.Lock()
+        self.hits = []
+        self.misses = []
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        if self._ssh_ip is not None:
+            self._entries = read_remote_json(self._ssh_user, self._ssh_ip, self._path)
+        else:
+            self._entries = mf.load_manifest(self._path)
+        self._entries = self._entries or {}
+        return self._entries
+
+    def _save(self):
+        if self._ssh_ip is not None:
+            write_remote_json(self._ssh_user, self._ssh_ip, self._path, self._entries)
+        else:
+            mf.save_manifest(self._path, self._entries)
+
+    def is_fresh(self, image, fingerprint):
+        """Check if image was built from fingerprint and still exists."""
+        with self._lock:
+            known = self._load().get(image)
+        fresh = known == fingerprint \
+            and inspect_image(image, self._ssh_user, self._ssh_ip) is not None
+        (self.hits if fresh else self.misses).append(image)
+        return fresh
+
+    def update(self, image, fingerprint):
+        """Store that image was just built from fingerprint."""
+        with self._lock:
+            self._load()[image] = fingerprint
+            self._save()
+
+    def report(self):
+        return "Build cache: %d hits, %d misses" % (len(self.hits), len(self.misses))
@@ -0,0 +1,162 @@
+from argparse import Namespace
+import os
+import json
+import getpass
+from . import custom_exceptions as ce
+
+
+def check_for_cfg(project_dir):
+    return os.path.exists(os.path.join(project_dir, "bwd.json"))
+
+
+def is_remote(args):
+    """Check if the build setting args runs on a remote host.
+
+    Hosts written as user@ip need no "ssh_user", see fanout.get_hosts.
+
+    Raises
+    ------
+    ce.InvalidSetting
+        Some hosts have a user and others have none to use
+    """
+    if args.ssh_ip is None or args.remote_folder is None:
+        return False
+    if args.ssh_user is not None:
+        return True
+    ips = args.ssh_ip if isinstance(args.ssh_ip, list) else [args.ssh_ip]
+    with_user = ['@' in ip for ip in ips]
+    if all(with_user):
+        return True
+    if any(with_user):
+        raise ce.InvalidSetting('ssh_ip', args.ssh_ip,
+                                "user@ip for every host when there is no \"ssh_user\"")
+    return False
+
+
+def positive_setting(args, name, default):
+    """The count or seconds name of the build setting args, default when it is not set.
+
+    Raises
+    ------
+    ce.InvalidSetting
+        The setting is not a whole number above 0
+    """
+    value = getattr(args, name, None)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        raise ce.InvalidSetting(name, value, "a whole number above 0")
+    return value
+
+
+def lists_requirements(project_dir, build_name):
+    """Check if the build setting build_name lists "requirements", without resolving it.
+
+    The setting is looked up as get_build_setting does, the first one
+    of the user or "common" when build_name is not found.
+    """
+    with open(os.path.join(project_dir, "bwd.json"), 'r') as f:
+        cfg = json.load(f)
+    build_settings = cfg.get(getpass.getuser(), []) + cfg.get("common", [])
+    if not build_settings:
+        return False
+    matching = [setting for setting in build_settings if setting.get('build_name') == build_name]
+    return bool((matching or build_settings)[0].get('requirements'))
+
+
+def parse_cfg_file(project_dir):
+    file = os.path.join(project_dir, "bwd.json")
+    with open(file, 'r') as f:
+        cfg = json.load(f)
+
+    # Add user
+    for user in cfg:
+        for build in cfg[user]:
+            build["user"] = user
+
+    # Fetch the current user
+    current_user = getpass.getuser()
+
+    # Check for these fields
+    check_these = [current_user, "common"]
+
+    # Fetch the configs
+    build_settings = []
+    for iCheck in check_these:
+        if iCheck in cfg:
+            build_settings += cfg[iCheck]
+
+    # Make sure it has build_cmd specified, if not
+    # issue a warning.
+    for i, i_setting in enumerate(build_settings):
+        if "build_cmd" not in i_setting:
+            print("Warning, build_cmd for %s / common not found" % current_user)
+        if "build_name" not in i_setting:
+            set_name = "%s_%d" % (i_setting["user"], i)
+            print("Warning, build_name for %s / common not found" % current_user)
+            print("Generated build name is %s" % set_name)
+            i_setting["build_name"] = set_name
+
+
+    build_names = [i_setting['build_name'] for i_setting in build_settings]
+    return build_settings, build_names
+
+
+def get_build_setting(args):
+    # Make sure that we are using absolute paths
+    args.proj = os.path.abspath(args.proj)
+    args.s = os.path.abspath(args.s)
+
+    build_settings, build_names = parse_cfg_file(args.proj)
+
+    # Check build
+    nr = 0
+    if args.build_name is not None:
+        if args.build_name in build_names:
+            nr = build_names.index(args.build_name)
+        else:
+            print("Could not find %s in build config." % args.build_name)
+            print("Using the first build settings as default.")
+    else:
+        print("No build name specified, using %s as default" % build_settings[nr]['build_name'])
+
+
+    def get_namespace(**kwargs):
+        param = {
+            'proj': args.proj,
+            's': args.s,
+            'build_name': kwargs.get('build_name', None),
+            'd': kwargs.get('docker_file', None),
+            'v': kwargs.get('volumes', None),
+            'p': kwargs.get('ports', None),
+            'gpu': kwargs.get('gpu', None),
+            'GUI': kwargs.get('GUI', None),
+            'ssh_ip': kwargs.get('ssh_ip', None),
+            'ssh_user': kwargs.get('ssh_user', None),
+            'remote_folder': kwargs.get('remote_folder', None),
+            'run_as_module': kwargs.get('run_as_module', False),
+            'build_cmd': kwargs.get('build_cmd', None),
+            'custom_cmd': kwargs.get('custom_cmd', None),
+            'disable_docker': kwargs.get('disable_docker', False),
+            'sync': kwargs.get('sync', 'delta'),
+            'use_gitignore': kwargs.get('use_gitignore', False),
+            'build_cache': kwargs.get('build_cache', True),
+            'warm': kwargs.get('warm', False),
+            'warm_idle_timeout': kwargs.get('warm_idle_timeout', None),
+            'max_parallel_hosts': kwargs.get('max_parallel_hosts', None),
+            'relay': kwargs.get('relay', False),
+            'snapshot_keep': kwargs.get('snapshot_keep', None),
+            'snapshot_budget_mb': kwargs.get('snapshot_budget_mb', None),
+            'ship_image': kwargs.get('ship_image', False),
+            'batch_workers': kwargs.get('batch_workers', 4),
+            'batch_containers': kwargs.get('batch_containers', 1),
+            'outputs': kwargs.get('outputs', []),
+            'outputs_interval': kwargs.get('outputs_interval', None),
+            'requirements': kwargs.get('requirements', []),
+            'deps_from': kwargs.get('deps_from', None),
+            'pip_cache': kwargs.get('pip_cache', False),
+        }
+
+        return Namespace(**param)
+
+    return get_namespace(**build_settings[nr])
@@ -37,3 +37,69 @@ class NoDockerfileSpecified(Exception):
         if message is None:
             msg = "You need to specify which Dockerfile to use as image"
             Exception.__init__(self, msg)
+
+
+class CircularDependency(Exception):
+    def __init__(self, names):
+        msg = "The Dockerfiles %s are built FROM each other" % ', '.join(names)
+        Exception.__init__(self, msg)
+
+
+class DepsBaseMissing(Exception):
+    def __init__(self):
+        msg = "The build setting lists requirements, but no deps_from image to install them in"
+        Exception.__init__(self, msg)
+
+
+class CircularStages(Exception):
+    def __init__(self, names):
+        msg = "The stages %s wait on each other, or on a stage that does not exist" % ', '.join(names)
+        Exception.__init__(self, msg)
+
+
+class BuildFailed(Exception):
+    def __init__(self, names):
+        msg = "Could not build %s" % ', '.join(names)
+        Exception.__init__(self, msg)
+
+
+class InvalidSetting(Exception):
+    def __init__(self, name, value, expected):
+        msg = "\"%s\": %r in the build setting, it must be %s" % (name, value, expected)
+        Exception.__init__(self, msg)
+
+
+class HostsFailed(Exception):
+    def __init__(self, hosts):
+        msg = "The run failed on %s" % ', '.join(hosts)
+        Exception.__init__(self, msg)
+
+
+class NoGpusConfigured(Exception):
+    def __init__(self, message=None):
+        if message is None:
+            message = "Running a job queue needs a gpu list in the build setting"
+        Exception.__init__(self, message)
+
+
+class JobsFailed(Exception):
+    def __init__(self, jobs):
+        msg = "%d jobs failed: %s" % (len(jobs), ', '.join(jobs))
+        Exception.__init__(self, msg)
+
+
+class ImageMissing(Exception):
+    def __init__(self, image):
+        msg = "There is no local docker image %s, build it with -build_image" % image
+        Exception.__init__(self, msg)
+
+
+class CommandFailed(Exception):
+    def __init__(self, returncode, cmd, tail):
+        msg = "Command '%s' returned non-zero exit status %d." % (cmd, returncode)
+        if tail:
+            msg = "%s Last output:\n%s" % (msg, '\n'.join(tail))
+        Exception.__init__(self, msg)
+        self.returncode = returncode
+        self.cmd = cmd
+        self.tail = tail
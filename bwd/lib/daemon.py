@@ -0,0 +1,224 @@
+import io
+import os
+import json
+import getpass
+import tempfile
+import contextlib
+from argparse import Namespace
+
+from . import config
+from . import utils
+
+# The daemon listens here, one daemon per user
+SOCKET_PATH = os.environ.get(
+    'BWD_SOCKET', os.path.join(tempfile.gettempdir(), 'bwd-%s.sock' % getpass.getuser()))
+# Seconds the client waits for an answer before doing the work itself,
+# and the daemon waits for a client to send or take its data
+TIMEOUT = 5
+
+
+class DaemonUnavailable(Exception):
+    def __init__(self, message=None):
+        if message is None:
+            message = "No bwd daemon is listening on %s" % SOCKET_PATH
+        Exception.__init__(self, message)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class BwdDaemon():
+    """Keeps parsed configs, build settings, commands and Dockerfile
+    listings in memory. Entries are dropped when the files they were
+    made from change, which is told by their mtime."""
+    def __init__(self):
+        self._settings = {}
+        self._commands = {}
+        self._dockerfiles = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, cache, key, stamp, make):
+        """Return the cached (result, output) of make, if stamp is unchanged.
+
+        Whatever make prints is captured, so the client can print it.
+        """
+        entry = cache.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = make()
+        cache[key] = (stamp, (result, output.getvalue()))
+        return cache[key][1]
+
+    def build_setting(self, proj, s, build_name):
+        """The resolved build setting of a run, see config.get_build_setting."""
+        stamp = _mtime(os.path.join(proj, "bwd.json"))
+
+        def make():
+            args = Namespace(proj=proj, s=s, build_name=build_name)
+            return vars(config.get_build_setting(args))
+
+        return self._cached(self._settings, (proj, s, build_name), stamp, make)
+
+    def command(self, settings, ssh_result):
+        """The docker command of a run, see BuildWithDocker."""
+        from .docker_classes import BuildWithDocker
+        proj = settings['proj']
+        stamp = (_mtime(os.path.join(proj, "bwd.json")),
+                 _mtime(os.path.join(proj, 'Dockerfiles')))
+
+        def make():
+            bwd = BuildWithDocker(proj, ssh_result)
+            bwd.add_arguments(Namespace(**settings))
+            return bwd.get_command()
+
+        key = (json.dumps(settings, sort_keys=True), ssh_result)
+        return self._cached(self._commands, key, stamp, make)
+
+    def dockerfiles(self, project_dir, ssh_user, ssh_ip, source_dir):
+        """The Dockerfiles of a project, see utils.get_dockerfiles.
+
+        Remote listings are dropped when the local copy of the
+        Dockerfiles folder, in source_dir, changes.
+        """
+        stamp = _mtime(os.path.join(source_dir or project_dir, 'Dockerfiles'))
+
+        def make():
+            return utils.get_dockerfiles(project_dir, ssh_user, ssh_ip)
+
+        key = (project_dir, ssh_user, ssh_ip)
+        return self._cached(self._dockerfiles, key, stamp, make)
+
+    def handle(self, message):
+        """Answer one request, a dict with the method name and its kwargs."""
+        if message.get('method') == 'stats':
+            return {'result': {'hits': self.hits, 'misses': self.misses}, 'output': ''}
+        if message.get('method') not in ('build_setting', 'command', 'dockerfiles'):
+            return {'error': "Unknown request %s" % message.get('method')}
+        try:
+            result, output = getattr(self, message['method'])(**message.get('kwargs', {}))
+        except Exception as e:
+            return {'error': repr(e)}
+        return {'result': result, 'output': output}
+
+
+def _recv_line(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def serve(socket_path=None):
+    """Answer requests on socket_path until interrupted."""
+    import socket
+
+    socket_path = socket_path or SOCKET_PATH
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    daemon = BwdDaemon()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only this user may connect, from the moment the socket exists
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    print("bwd daemon listening on %s" % socket_path)
+    try:
+        while True:
+            conn, _ = server.accept()
+            # A stalled client must not hold up the next ones
+            conn.settimeout(TIMEOUT)
+            with conn:
+                try:
+                    message = json.loads(_recv_line(conn).decode())
+                    response = daemon.handle(message)
+                except ValueError as e:
+                    response = {'error': repr(e)}
+                except OSError as e:
+                    print("Could not read a request: %r" % e)
+                    continue
+                try:
+                    conn.sendall(json.dumps(response).encode() + b'\n')
+                except OSError as e:
+                    # The client gave up waiting, it does the work itself
+                    print("Could not answer a request: %r" % e)
+    except KeyboardInterrupt:
+        print("Stopping bwd daemon")
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def request(method, socket_path=None, **kwargs):
+    """Ask the daemon, print what it printed and return its answer.
+
+    Raises
+    ------
+    DaemonUnavailable
+        No daemon is running, or it could not answer
+    """
+    socket_path = socket_path or SOCKET_PATH
+    if not os.path.exists(socket_path):
+        raise DaemonUnavailable()
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(TIMEOUT)
+            conn.connect(socket_path)
+            conn.sendall(json.dumps({'method': method, 'kwargs': kwargs}).encode() + b'\n')
+            response = json.loads(_recv_line(conn).decode())
+    except (OSError, ValueError) as e:
+        raise DaemonUnavailable(repr(e))
+
+    if 'error' in response:
+        raise DaemonUnavailable(response['error'])
+    if response['output']:
+        print(response['output'], end='')
+    return response['result']
+
+
+def get_build_setting(args):
+    """config.get_build_setting, answered by the daemon if one is running."""
+    args.proj = os.path.abspath(args.proj)
+    args.s = os.path.abspath(args.s)
+    try:
+        return Namespace(**request(
+            'build_setting', proj=args.proj, s=args.s, build_name=args.build_name))
+    except DaemonUnavailable:
+        return config.get_build_setting(args)
+
+
+def get_command(args, ssh_result):
+    """The docker command of a run, made by the daemon if one is running."""
+    try:
+        return request('command', settings=vars(args), ssh_result=ssh_result)
+    except DaemonUnavailable:
+        from .docker_classes import BuildWithDocker
+        bwd = BuildWithDocker(args.proj, ssh_result)
+        bwd.add_arguments(args)
+        return bwd.get_command()
+
+
+def get_dockerfiles(project_dir, ssh_user=None, ssh_ip=None, source_dir=None):
+    """utils.get_dockerfiles, answered by the daemon if one is running."""
+    try:
+        return request('dockerfiles', project_dir=project_dir, ssh_user=ssh_user,
+                       ssh_ip=ssh_ip, source_dir=source_dir)
+    except DaemonUnavailable:
+        return utils.get_dockerfiles(project_dir, ssh_user, ssh_ip)
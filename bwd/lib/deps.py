@@ -0,0 +1,173 @@
+import os
+import shlex
+import getpass
+import hashlib
+
+from . import custom_exceptions as ce
+from . import build_cache as bc
+from . import probe
+from . import trace
+from . import utils
+
+# Dependency images are kept under this name, tagged with their hash,
+# so every project and Dockerfile with the same dependencies shares one
+DEPS_REPOSITORY = 'bwd-deps'
+# The dependency image of a project is also tagged <project>:deps
+DEPS_NAME = 'deps'
+# Where the pip cache of the host is mounted in containers
+PIP_CACHE_MOUNT = '/bwd-pip-cache'
+# The pip cache of local runs, remote ones keep it next to the workspaces
+LOCAL_PIP_CACHE = os.path.join('~', '.cache', 'bwd-pip')
+
+
+def get_pip_cache(args, remote):
+    """Return the folder of the pip cache of a host, None without one.
+
+    "pip_cache" is either a path, or true for the default folder, one
+    per user on each host. remote tells if the host is the remote of
+    args or this machine.
+    """
+    if not args.pip_cache:
+        return None
+    if not isinstance(args.pip_cache, bool):
+        return args.pip_cache
+    if remote:
+        return os.path.join(args.remote_folder, getpass.getuser(), '.bwd-pip-cache')
+    return os.path.expanduser(LOCAL_PIP_CACHE)
+
+
+def pip_cache_options(pip_cache):
+    """Return the docker run options that give a container the pip cache."""
+    return "-v %s:%s -e PIP_CACHE_DIR=%s" % (pip_cache, PIP_CACHE_MOUNT, PIP_CACHE_MOUNT)
+
+
+class DepsLayer():
+    """The python dependencies of a project, as an image its Dockerfiles build FROM.
+
+    The image is ``base`` with the requirement files pip installed, and
+    is named after the hash of both. It is built once per host, and
+    tagged <project>:deps for the Dockerfiles of each project using it.
+    """
+    def __init__(self, base, requirements, pip_cache=None):
+        """Initialize class
+
+        Parameters
+        ----------
+        base : str
+            Image to install the requirements in, it must have pip
+        requirements : list
+            Requirement files, relative to the project root
+        pip_cache : str, optional
+            Folder on the host to keep the pip cache in between builds
+
+        """
+        self._base = base
+        self._requirements = utils.get_as_list(requirements)
+        self._pip_cache = pip_cache
+
+    def get_image(self, source_dir):
+        """Return the name of the dependency image, from the local requirement files."""
+        sha = hashlib.sha1(self._base.encode())
+        for path in self._requirements:
+            sha.update(b'\0' + path.encode() + b'\0')
+            with open(os.path.join(source_dir, path), 'rb') as f:
+                sha.update(f.read())
+        return "%s:%s" % (DEPS_REPOSITORY, sha.hexdigest()[:16])
+
+    def get_build_command(self, image, project_dir):
+        """Return the shell command that makes image on its host.
+
+        The requirements are installed in a container of the base image
+        and the container is committed, so the pip cache of the host can
+        be mounted, which docker build can not do without BuildKit.
+        """
+        container = image.replace(':', '_')
+        install = "cd /bwd-project && pip install %s" % ' '.join(
+            '-r %s' % shlex.quote(path) for path in self._requirements)
+        options = "-v %s:/bwd-project:ro" % project_dir
+        if self._pip_cache is not None:
+            options = "%s %s" % (options, pip_cache_options(self._pip_cache))
+
+        # The command of the container would become the one of the image
+        cmd = "$(docker image inspect -f %s %s)" % (
+            shlex.quote('{{if .Config.Cmd}}{{json .Config.Cmd}}{{else}}[]{{end}}'), self._base)
+        return (
+            "docker rm -f %(ctr)s >/dev/null 2>&1; "
+            "docker run --name %(ctr)s %(options)s %(base)s sh -c %(install)s && "
+            "docker commit --change \"CMD %(cmd)s\" %(ctr)s %(image)s >/dev/null; "
+            "status=$?; docker rm -f %(ctr)s >/dev/null 2>&1; exit $status" % {
+                'ctr': container, 'options': options, 'base': self._base,
+                'install': shlex.quote(install), 'cmd': cmd, 'image': image})
+
+    def ensure(self, project_image, project_dir, source_dir=None, ssh_user=None, ssh_ip=None):
+        """Make sure project_image is the dependency image, building it if needed.
+
+        Parameters
+        ----------
+        project_image : str
+            The name the Dockerfiles of the project use, <project>:deps
+        project_dir : str
+            The project folder, on the remote host for remote builds
+        source_dir : str, optional
+            Local copy of project_dir, to hash the requirement files
+        ssh_user : str, optional
+            User name of the remote-host machine
+        ssh_ip : str, optional
+            IP address of the remote-host machine
+
+        Returns
+        -------
+        str
+            'cached' when the host had the dependency image, else 'built'
+
+        Raises
+        ------
+        ce.CommandFailed
+            The requirements could not be installed
+        """
+        image = self.get_image(source_dir or project_dir)
+        with trace.span('deps', image=image) as span:
+            if bc.inspect_image(image, ssh_user, ssh_ip) is not None:
+                status = 'cached'
+                script = None
+            else:
+                print("%sInstalling %s in %s as %s" % (
+                    utils.get_prefix(), ', '.join(self._requirements), self._base, image))
+                status = 'built'
+                script = "(%s)" % self.get_build_command(image, project_dir)
+                if self._pip_cache is not None:
+                    script = "mkdir -p %s && %s" % (self._pip_cache, script)
+
+            if status == 'built' or bc.inspect_image(project_image, ssh_user, ssh_ip) != \
+                    bc.inspect_image(image, ssh_user, ssh_ip):
+                tag = "docker tag %s %s" % (image, project_image)
+                script = tag if script is None else "%s && %s" % (script, tag)
+
+            if script is not None:
+                if ssh_ip is not None:
+                    from .ssh_utils import append_ssh
+                    script = append_ssh(ssh_user, ssh_ip, shlex.quote(script))
+                    probe.forget_image(ssh_user, ssh_ip, image)
+                    probe.forget_image(ssh_user, ssh_ip, project_image)
+                else:
+                    script = "sh -c %s" % shlex.quote(script)
+                utils.run_and_stream(script, debug=True, prefix='[%s] ' % DEPS_NAME)
+            span.add(status=status)
+        return status
+
+
+def from_args(args, remote):
+    """Return the DepsLayer of a build setting, None if it lists no "requirements".
+
+    remote tells if the image is made on the remote of args, or here.
+
+    Raises
+    ------
+    ce.DepsBaseMissing
+        There are requirements, but no "deps_from" image to install them in
+    """
+    if not args.requirements:
+        return None
+    if not args.deps_from:
+        raise ce.DepsBaseMissing()
+    return DepsLayer(args.deps_from, args.requirements, get_pip_cache(args, remote))
@@ -1,8 +1,15 @@
 import os
+import shlex
 import getpass
 from . import custom_exceptions as ce
 from . import utils as utils
+from . import config
 GPU = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+# Seconds a warm container is kept running without any run in it
+WARM_IDLE_TIMEOUT = 1800
+WARM_POLL = 15
+WARM_LAST_USE = '/tmp/.bwd_last_use'
+WARM_BUSY = '/tmp/.bwd_busy'
 
 
 class BuildWithDocker():
@@ -22,6 +29,7 @@ class BuildWithDocker():
         self._cmd = "docker run -t --rm -w %s" % project_dir
         self._has_gpu = None
         self._project_dir = project_dir
+        self._is_remote = remote_folder is not None
 
         self._volumes = None
         self._ports = None
@@ -29,6 +37,9 @@ class BuildWithDocker():
         self._gui = False
         self._exec = None
         self._docker_image = None
+        self._ctr_name = None
+        self._image = None
+        self._warm_timeout = None
         self._custom_cmd = None
 
         # Add project as volume. If this is a ssh build, then we
@@ -70,6 +81,13 @@ class BuildWithDocker():
             self._ports = "%s -p %s" % \
                 (self._ports, p)
 
+    def add_pip_cache(self, args):
+        """Mounts the pip cache of the host, if the build setting keeps one."""
+        if not getattr(args, 'pip_cache', False):
+            return
+        from .deps import get_pip_cache, pip_cache_options
+        self.add_custom_command(pip_cache_options(get_pip_cache(args, remote=self._is_remote)))
+
     def add_gui(self, gui_on):
         """Adds GUI support."""
         if gui_on is None or not gui_on:
@@ -85,13 +103,34 @@ class BuildWithDocker():
         self._has_gpu = gpu_nr
         self._gpus = "NV_GPU=%s nvidia-" % ','.join(["%d" % g for g in gpu_nr])
 
-    def add_exec_script(self, script_path, run_as_module=False, shell="python -m"):
-        """Adds the execution script."""
+    def add_exec_script(self, script_path, run_as_module=False, shell="python -m", script_args=None):
+        """Adds the execution script, and the arguments to pass it."""
         if run_as_module:
             suffix = utils.get_module_path(self._project_dir, script_path)
         else:
             suffix = os.path.relpath(script_path, self._project_dir)
         self._exec = "%s %s" % (shell, suffix)
+        if script_args:
+            self._exec = "%s %s" % (self._exec, ' '.join(shlex.quote(a) for a in script_args))
+
+    def add_batch(self, scripts, run_as_module=False, shell="python", workers=4, index=None):
+        """Run many scripts in this one container, see batch_runner.
+
+        shell must be a python interpreter. With index, the container
+        is one of a pool and is named after it.
+        """
+        with open(os.path.join(os.path.dirname(__file__), 'batch_runner.py'), 'r') as f:
+            runner = f.read()
+        if run_as_module:
+            targets = ['-m'] + [utils.get_module_path(self._project_dir, s) for s in scripts]
+        else:
+            targets = [os.path.relpath(s, self._project_dir) for s in scripts]
+        self._exec = "%s -c %s %d %s" % (
+            shell, shlex.quote(runner), workers, ' '.join(shlex.quote(t) for t in targets))
+
+        if index is not None and self._ctr_name is not None:
+            self._ctr_name = "%s_batch%d" % (self._ctr_name, index)
+            self._docker_image = "--name %s %s" % (self._ctr_name, self._image)
 
     def add_docker_image(self, docker_file):
         """Adds the desired docker image to run from."""
@@ -105,7 +144,13 @@ class BuildWithDocker():
         if self._has_gpu:
             append_letter = '_'.join([GPU[idx] for idx in self._has_gpu])
             ctr_name = "GPU_%s_%s" % (append_letter, ctr_name)
-        self._docker_image = "--name %s %s:%s" % (ctr_name, proj_name, tag_name)
+        self._ctr_name = ctr_name
+        self._image = "%s:%s" % (proj_name, tag_name)
+        self._docker_image = "--name %s %s" % (ctr_name, self._image)
+
+    def set_warm(self, idle_timeout=WARM_IDLE_TIMEOUT):
+        """Run in a long lived container with docker exec, see get_warm_command."""
+        self._warm_timeout = idle_timeout
 
     def add_arguments(self, args):
         self.add_volume(args.v)
@@ -114,7 +159,76 @@ class BuildWithDocker():
         self.add_gui(args.GUI)
         self.add_custom_command(args.custom_cmd)
         self.add_docker_image(args.d)
-        self.add_exec_script(args.s, args.run_as_module, shell=args.build_cmd)
+        self.add_pip_cache(args)
+        if getattr(args, 'batch', None):
+            self.add_batch(args.batch, args.run_as_module, shell=args.build_cmd,
+                           workers=args.batch_workers, index=getattr(args, 'batch_index', None))
+        else:
+            self.add_exec_script(args.s, args.run_as_module, shell=args.build_cmd,
+                                 script_args=getattr(args, 'script_args', None))
+        if args.warm:
+            self.set_warm(config.positive_setting(args, 'warm_idle_timeout', WARM_IDLE_TIMEOUT))
+
+    def get_warm_command(self):
+        """Returns a shell command that runs the script in a warm container.
+
+        The container is named after the usual container name and kept
+        running between runs, the script is sent in with docker exec. It is
+        restarted when the image or the run options change, and stops by
+        itself after it has been idle for the idle timeout.
+        """
+        import hashlib
+
+        options = [self._volumes, self._ports, self._gui, self._custom_cmd]
+        options = ' '.join(opt.strip() for opt in options if opt)
+        docker = "%sdocker" % (self._gpus or '')
+        ctr_name = "%s_warm" % self._ctr_name
+        config = hashlib.sha1(
+            ("%s %s %s %s" % (docker, self._project_dir, options, self._image)).encode()
+        ).hexdigest()
+
+        # The container waits until no exec has been running for a while
+        idle_loop = (
+            "touch %(last)s; while sleep %(poll)d; do "
+            "ls %(busy)s.* >/dev/null 2>&1 && continue; "
+            "[ $(( $(date +%%s) - $(stat -c %%Y %(last)s) )) -ge %(timeout)d ] && exit 0; "
+            "done" % {'last': WARM_LAST_USE, 'busy': WARM_BUSY, 'poll': WARM_POLL,
+                      'timeout': self._warm_timeout})
+        run = "%s run -d --rm -w %s %s --label bwd.config=%s --name %s %s sh -c %s" % (
+            docker, self._project_dir, options, config, ctr_name, self._image,
+            shlex.quote(idle_loop))
+
+        state = "docker inspect -f %s %s 2>/dev/null" % (
+            shlex.quote('{{.State.Running}} {{index .Config.Labels "bwd.config"}} {{.Image}}'),
+            ctr_name)
+        expected = "true %s $(docker image inspect -f %s %s 2>/dev/null)" % (
+            config, shlex.quote('{{.Id}}'), self._image)
+        restart = "docker rm -f %s >/dev/null 2>&1; %s >/dev/null" % (ctr_name, run)
+
+        # Mark the container busy while the script runs
+        wrapper = (
+            "f=%s.$$; touch $f; trap 'rm -f $f; touch %s' EXIT; "
+            "trap 'exit 130' INT TERM HUP; \"$@\"" % (WARM_BUSY, WARM_LAST_USE))
+        run_exec = "%s exec -t -w %s %s sh -c %s sh %s" % (
+            docker, self._project_dir, ctr_name, shlex.quote(wrapper), self._exec)
+
+        return '[ "$(%s)" = "%s" ] || { %s; }; %s' % (state, expected, restart, run_exec)
+
+    def get_stop_command(self):
+        """Returns a shell command that stops what get_command started.
+
+        The container of a run is removed. In a warm container the
+        scripts sent in with docker exec are ended, each with its process
+        group, and the container keeps running.
+        """
+        if self._ctr_name is None:
+            raise ce.NoDockerfileSpecified()
+
+        if self._warm_timeout is not None:
+            kill = 'for f in %s.*; do [ -e "$f" ] && kill -TERM -- "-${f##*.}"; done' % WARM_BUSY
+            return "docker exec %s_warm sh -c %s >/dev/null 2>&1; true" % (
+                self._ctr_name, shlex.quote(kill))
+        return "docker rm -f %s >/dev/null 2>&1; true" % self._ctr_name
 
     def get_command(self):
         """Returns the complete docker command."""
@@ -124,6 +238,9 @@ class BuildWithDocker():
         if self._docker_image is None:
             raise ce.NoDockerfileSpecified()
 
+        if self._warm_timeout is not None:
+            return self.get_warm_command()
+
         add_order = [
             self._volumes,
             self._ports,
@@ -151,19 +268,3 @@ class BuildWithDocker():
             return
 
         self._cmd = "%s %s" % (self._cmd, cmd)
-
-
-class DockerImages():
-    def __init__(self, project_dir, ssh_user=None, ssh_ip=None):
-        self._project_dir = project_dir
-        self._docker_build = utils.get_docker_build_commands(project_dir, ssh_user, ssh_ip)
-
-    def build_all(self):
-        for ibuild in self._docker_build:
-            utils.run_and_stream(self._docker_build[ibuild], debug=True)
-
-    def build_one(self, docker_name):
-        if docker_name not in self._docker_build:
-            raise ce.DockerFileMissing(docker_name)
-        utils.run_and_stream(self._docker_build[docker_name], debug=True)
-
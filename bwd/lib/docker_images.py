@@ -0,0 +1,299 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import custom_exceptions as ce
+from . import utils as utils
+from . import archive
+from . import build_cache as bc
+from . import ignore as ig
+from . import manifest as mf
+from . import probe
+from . import trace
+from .deps import DEPS_NAME
+# Default number of docker builds that run at the same time
+MAX_PARALLEL_BUILDS = 2
+
+
+class DockerImages():
+    def __init__(self, project_dir, ssh_user=None, ssh_ip=None, ignore=None,
+                 source_dir=None, cache_dir=None, use_cache=True, dockerfiles=None, deps=None):
+        """Initialize class
+
+        Parameters
+        ----------
+        project_dir : str
+            Full path to the project directory, on the remote host
+            for remote builds
+        ssh_user : None, optional
+            User name of the remote-host machine
+        ssh_ip : None, optional
+            IP address of the remote-host machine
+        ignore : IgnoreFilter, optional
+            Files left out of the build context, read from the
+            project ignore files if not given
+        source_dir : str, optional
+            Local copy of project_dir, used to fingerprint the builds
+        cache_dir : str, optional
+            Folder of the build cache, the .bwd folder of project_dir
+            by default
+        use_cache : bool, optional
+            Skip builds whose fingerprint matches an existing image
+        dockerfiles : dict, optional
+            Output of utils.get_dockerfiles, it is looked up if not given
+        deps : DepsLayer, optional
+            The dependency image of the project, made before the builds
+            as <project>:deps, see deps.py
+
+        """
+        self._project_dir = project_dir
+        self._source_dir = source_dir or project_dir
+        self._ssh_user = ssh_user
+        self._ssh_ip = ssh_ip
+        self._is_remote = ssh_ip is not None
+        self._ignore = ignore if ignore is not None else ig.load_ignore(self._source_dir)
+        self._use_cache = use_cache
+        self._deps = deps
+        self._cache = bc.BuildCache(
+            cache_dir or os.path.join(project_dir, mf.STATE_DIR), ssh_user, ssh_ip)
+        if dockerfiles is None:
+            dockerfiles = utils.get_dockerfiles(project_dir, ssh_user, ssh_ip)
+        self._dockerfiles = dockerfiles
+        self._docker_build = utils.get_docker_build_commands(
+            project_dir, ssh_user, ssh_ip, dockerfiles=self._dockerfiles)
+        self._lock = threading.Lock()
+
+    def get_context_files(self, docker_name):
+        """Find the files the build needs, the ones its Dockerfile COPY/ADDs.
+
+        The whole project, without its ignored files, is the context if
+        a source can not be told, e.g. it uses a build argument.
+
+        Returns
+        -------
+        list
+            Paths relative to the project, the Dockerfile among them
+        """
+        dockerfile = os.path.relpath(self._dockerfiles[docker_name], self._project_dir)
+        files = list(mf.walk_project(self._source_dir, ignore=self._ignore))
+        with open(os.path.join(self._source_dir, dockerfile), 'rb') as f:
+            _, sources = bc.parse_dockerfile(f.read().decode('utf-8', 'replace'))
+
+        context = files
+        if not any('$' in source for source in sources):
+            context = sorted(bc.match_sources(sources, files))
+        # Docker always needs the Dockerfile, even if it is ignored
+        if dockerfile not in context:
+            context.append(dockerfile)
+
+        def size(paths):
+            return sum(os.path.getsize(os.path.join(self._source_dir, p)) for p in paths)
+
+        full_size, context_size = size(files), size(context)
+        trace.add(context_files=len(context), context_bytes_full=full_size)
+        print("%sBuild context of %s: %d of %d files, %.1f of %.1f MB" % (
+            utils.get_prefix(), docker_name, len(context), len(files),
+            context_size / 1e6, full_size / 1e6))
+        return context
+
+    def get_context(self, docker_name):
+        """Stream the build context, see get_context_files."""
+        return archive.iter_tar_gz(self._project_dir, self.get_context_files(docker_name))
+
+    def get_image_name(self, docker_name):
+        return "%s:%s" % (os.path.basename(self._project_dir), docker_name)
+
+    def get_dependencies(self):
+        """Find which of the project images each image is built FROM.
+
+        Returns
+        -------
+        dict
+            Dictionary where the key is the name of the docker-file and
+            the value the set of docker-file names it depends on
+        """
+        names = {self.get_image_name(name).lower(): name for name in self._dockerfiles}
+        dependencies = {}
+        for name, full_path in self._dockerfiles.items():
+            dockerfile = os.path.join(
+                self._source_dir, os.path.relpath(full_path, self._project_dir))
+            try:
+                with open(dockerfile, 'r') as f:
+                    base_images, _ = bc.parse_dockerfile(f.read())
+            except OSError:
+                base_images = []
+            dependencies[name] = {
+                names[image.lower()] for image in base_images if image.lower() in names}
+        return dependencies
+
+    def get_base_images(self, docker_name):
+        """Find the images from outside the project that docker_name is built on.
+
+        The project images it is built FROM are followed, so their base
+        images are found too. Images named with a build argument, and
+        scratch, are left out.
+
+        Returns
+        -------
+        list
+            Names of the images, each once
+        """
+        project = {self.get_image_name(name).lower(): name for name in self._dockerfiles}
+        deps_image = self.get_image_name(DEPS_NAME).lower()
+        images = []
+        stack = [docker_name]
+        seen = set()
+        while stack:
+            name = stack.pop()
+            if name in seen or name not in self._dockerfiles:
+                continue
+            seen.add(name)
+            dockerfile = os.path.join(
+                self._source_dir, os.path.relpath(self._dockerfiles[name], self._project_dir))
+            try:
+                with open(dockerfile, 'r') as f:
+                    base_images, _ = bc.parse_dockerfile(f.read())
+            except OSError:
+                continue
+            for image in base_images:
+                if image.lower() in project:
+                    stack.append(project[image.lower()])
+                elif '$' not in image and image.lower() not in ('scratch', deps_image) \
+                        and image not in images:
+                    images.append(image)
+        return images
+
+    def _build(self, docker_name):
+        """Build one image, return 'cached' or 'built'."""
+        with trace.span('docker_build', image=docker_name) as span:
+            status = self._build_traced(docker_name)
+            span.add(status=status)
+        return status
+
+    def _build_traced(self, docker_name):
+        image = self.get_image_name(docker_name)
+        fingerprint = None
+        if self._use_cache:
+            dockerfile = os.path.relpath(self._dockerfiles[docker_name], self._project_dir)
+            # The fingerprint updates the local manifest, one build at a time
+            with self._lock, trace.span('fingerprint'):
+                fingerprint = bc.fingerprint(
+                    self._source_dir, dockerfile, self._ignore, self._ssh_user, self._ssh_ip)
+            if self._cache.is_fresh(image, fingerprint):
+                print("%s is up to date, skipping the build" % image)
+                return 'cached'
+
+        # Remote builds tar the context there, from the listed files
+        if self._is_remote:
+            context = ['\0'.join(self.get_context_files(docker_name)).encode()]
+        else:
+            context = trace.counted(self.get_context(docker_name), key='context_bytes')
+        utils.run_and_stream(
+            self._docker_build[docker_name], debug=True, stdin=context,
+            prefix='[%s] ' % docker_name)
+
+        # The probe of this run knows the old id of the image
+        if self._is_remote:
+            probe.forget_image(self._ssh_user, self._ssh_ip, image)
+        if fingerprint is not None:
+            self._cache.update(image, fingerprint)
+        return 'built'
+
+    def _build_ordered(self, docker_names, max_parallel):
+        """Build images at the same time, each after the images it is FROM.
+
+        Returns
+        -------
+        dict
+            Dictionary where the key is the name of the docker-file and the
+            value is a (status, seconds) tuple
+        """
+        dependencies = self.get_dependencies()
+
+        # Also build whatever the requested images depend on
+        todo = set()
+        stack = list(docker_names)
+        while stack:
+            name = stack.pop()
+            if name not in todo:
+                todo.add(name)
+                stack.extend(dependencies[name])
+
+        @utils.in_caller_context
+        def timed_build(name):
+            start = time.time()
+            try:
+                return self._build(name), time.time() - start
+            except Exception as e:
+                print("Building %s failed: %s" % (name, e))
+                return 'failed', time.time() - start
+
+        results = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            while todo or running:
+                for name in sorted(todo):
+                    parents = dependencies[name]
+                    if any(results.get(p, ('',))[0] in ('failed', 'skipped') for p in parents):
+                        results[name] = ('skipped', 0.0)
+                        todo.discard(name)
+                    elif all(p in results for p in parents):
+                        running[executor.submit(timed_build, name)] = name
+                        todo.discard(name)
+
+                if not running:
+                    # Nothing left to wait for, unless the rest is a cycle
+                    if todo:
+                        raise ce.CircularDependency(sorted(todo))
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+
+        return results
+
+    def _finish(self, results):
+        """Print the per-image timings, raise if a build failed."""
+        print("Build summary:")
+        for name, (status, seconds) in sorted(results.items()):
+            print("\t%-20s %-8s %7.1fs" % (name, status, seconds))
+        print(self._cache.report())
+
+        failed = sorted(name for name, (status, _) in results.items() if status == 'failed')
+        if failed:
+            raise ce.BuildFailed(failed)
+
+    def _build_deps(self):
+        """Make the dependency image, return its (status, seconds)."""
+        start = time.time()
+        try:
+            status = self._deps.ensure(
+                self.get_image_name(DEPS_NAME), self._project_dir, self._source_dir,
+                self._ssh_user, self._ssh_ip)
+        except ce.CommandFailed:
+            status = 'failed'
+        return status, time.time() - start
+
+    def _build_with_deps(self, docker_names, max_parallel):
+        """Make the dependency image if there is one, then build docker_names.
+
+        Nothing is built when the dependency image could not be made.
+        """
+        results = {}
+        if self._deps is not None:
+            results[DEPS_NAME] = self._build_deps()
+            if results[DEPS_NAME][0] == 'failed':
+                return results
+        results.update(self._build_ordered(docker_names, max_parallel))
+        return results
+
+    def build_all(self, max_parallel=MAX_PARALLEL_BUILDS):
+        """Build every image, independent images at the same time."""
+        self._finish(self._build_with_deps(list(self._docker_build), max_parallel))
+
+    def build_one(self, docker_name, max_parallel=MAX_PARALLEL_BUILDS):
+        """Build one image, after the project images it is built FROM."""
+        if docker_name not in self._docker_build:
+            raise ce.DockerFileMissing(docker_name)
+        self._finish(self._build_with_deps([docker_name], max_parallel))
@@ -0,0 +1,173 @@
+import copy
+import time
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import custom_exceptions as ce
+from . import config
+from . import daemon
+from . import ssh_utils as ssh
+from . import trace
+from . import utils
+
+# Hosts that sync, build and run at the same time, unless the build
+# setting says otherwise with "max_parallel_hosts"
+MAX_PARALLEL_HOSTS = 4
+
+
+def get_hosts(args):
+    """Return the (ssh_user, ssh_ip) of every host of a build setting.
+
+    ssh_ip is one host or a list of them. A host written as user@ip
+    is connected to as that user instead of ssh_user.
+    """
+    ips = args.ssh_ip if isinstance(args.ssh_ip, list) else [args.ssh_ip]
+    hosts = []
+    for ip in ips:
+        user, _, ip = ip.rpartition('@')
+        hosts.append((user or args.ssh_user, ip))
+    return hosts
+
+
+def for_host(args, ssh_user, ssh_ip):
+    """Return a copy of the build setting args that runs on one host."""
+    host_args = copy.copy(args)
+    host_args.ssh_user = ssh_user
+    host_args.ssh_ip = ssh_ip
+    return host_args
+
+
+def get_run_command(args, ssh_result):
+    """Return the command that runs the build setting, on its host if remote.
+
+    Parameters
+    ----------
+    args : Namespace
+        The build setting, see config.get_build_setting
+    ssh_result : str
+        The folder the project was sent to, None when running locally
+
+    Returns
+    -------
+    str
+        The command to run locally
+    """
+    with trace.span('command'):
+        command = daemon.get_command(args, ssh_result)
+
+    # If disable docker, remove any docker related commands
+    if args.disable_docker:
+        print("Removing docker related commands")
+        print(command)
+        command = utils.remove_docker_cmd(command, args, ssh_result)
+        print(command)
+
+    # Append ssh command if needed
+    if ssh_result is not None:
+        # A warm command is a shell script, it must reach the remote shell whole
+        if args.warm and not args.disable_docker:
+            command = shlex.quote(command)
+        command = ssh.append_ssh(args.ssh_user, args.ssh_ip, command)
+
+    return command
+
+
+def run_on_host(args, relay_from=None, on_synced=None):
+    """Send, build and run the build setting args on its one host.
+
+    Output of the host is prefixed with its ip.
+
+    Parameters
+    ----------
+    args : Namespace
+        The build setting, for one host, see for_host
+    relay_from : tuple, optional
+        (ssh_user, ssh_ip) of a synced host to relay the files from
+    on_synced : callable, optional
+        Called once the project is on the host
+
+    Raises
+    ------
+    ce.CommandFailed
+        The run exited with an error
+    """
+    with utils.prefixed('[%s] ' % args.ssh_ip):
+        with trace.span('remote'):
+            ssh_result = ssh.maybe_send(args, relay_from=relay_from, on_synced=on_synced)
+        command = get_run_command(args, ssh_result)
+        with trace.span('run', image=args.d, warm=args.warm):
+            utils.run_and_stream(command, debug=True)
+
+
+def run_on_hosts(args, hosts, max_parallel=None):
+    """Run the build setting args on every host, several at the same time.
+
+    With "relay" set, the project is sent to the first host only, the
+    others get the files from it, so they leave this machine once.
+
+    Parameters
+    ----------
+    args : Namespace
+        The build setting, see config.get_build_setting
+    hosts : list
+        (ssh_user, ssh_ip) of each host, see get_hosts
+    max_parallel : int, optional
+        How many hosts to work on at the same time
+
+    Raises
+    ------
+    ce.HostsFailed
+        The run failed on some of the hosts
+    """
+    if max_parallel is None:
+        max_parallel = config.positive_setting(args, 'max_parallel_hosts', MAX_PARALLEL_HOSTS)
+    relay = args.relay and args.sync != 'snapshot'
+    seed = hosts[0]
+    seed_synced = threading.Event()
+    seed_ok = []
+
+    def synced():
+        seed_ok.append(seed)
+        seed_synced.set()
+
+    @utils.in_caller_context
+    def timed_run(host):
+        start = time.time()
+        relay_from = None
+        on_synced = None
+        if relay and host == seed:
+            on_synced = synced
+        elif relay:
+            # The seed syncs first, the others relay from it, or get
+            # the files from here if it failed
+            seed_synced.wait()
+            relay_from = seed if seed_ok else None
+        span = None
+        try:
+            with trace.span('host', host=host[1]) as span:
+                run_on_host(for_host(args, *host), relay_from=relay_from, on_synced=on_synced)
+            return 'done', time.time() - start
+        except Exception as e:
+            print("[%s] Failed: %s" % (host[1], e))
+            if span is not None:
+                span.add(exit_code=getattr(e, 'returncode', 1))
+            return 'failed', time.time() - start
+        finally:
+            if host == seed:
+                seed_synced.set()
+
+    print("Running on %d hosts, %d at a time%s" % (
+        len(hosts), max_parallel, ', relaying from %s' % seed[1] if relay else ''))
+    # The seed is submitted first, so it never waits for a free worker
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        futures = {host: executor.submit(timed_run, host) for host in hosts}
+        results = {host: future.result() for host, future in futures.items()}
+
+    print("Host summary:")
+    for (ssh_user, ssh_ip), (status, seconds) in sorted(results.items()):
+        print("\t%-30s %-8s %7.1fs" % ('%s@%s' % (ssh_user, ssh_ip), status, seconds))
+
+    failed = sorted(ip for (_, ip), (status, _) in results.items() if status == 'failed')
+    if failed:
+        raise ce.HostsFailed(failed)
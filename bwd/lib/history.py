@@ -0,0 +1,345 @@
+import os
+import math
+import time
+import datetime
+
+# The runs of every project are kept in this SQLite file, an empty
+# $BWD_HISTORY keeps no history
+HISTORY_PATH = os.environ.get(
+    'BWD_HISTORY', os.path.join(os.path.expanduser('~'), '.cache', 'bwd', 'history.sqlite'))
+# The host of runs on this machine
+LOCAL_HOST = 'local'
+# How many of the latest runs are compared with the runs before them
+RECENT_RUNS = 5
+# Runs before the recent ones needed to tell a regression
+MIN_BASELINE_RUNS = 5
+# A phase regressed when the median of the recent runs is this many
+# times the median of the runs before them
+REGRESSION_RATIO = 1.5
+# Phases shorter than this are too noisy to flag
+MIN_PHASE_SECONDS = 0.05
+# Spans that are not phases, they cover a whole run
+NOT_PHASES = ('bwd', 'host')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    project TEXT,
+    build_name TEXT,
+    host TEXT,
+    image TEXT,
+    mode TEXT,
+    payload_bytes INTEGER,
+    exit_code INTEGER,
+    total_s REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER REFERENCES runs(id),
+    name TEXT,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_setting ON runs (project, build_name, host, started);
+CREATE INDEX IF NOT EXISTS phases_by_run ON phases (run_id);
+"""
+
+
+def connect(path=HISTORY_PATH):
+    """Open the history, creating it if needed.
+
+    The history is an append only log, losing the last runs in a power
+    cut is fine, so writes do not wait for the disk.
+    """
+    import sqlite3
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+    # Runs that end at the same time wait for each other
+    db = sqlite3.connect(path, timeout=10)
+    db.execute("PRAGMA synchronous=OFF")
+    # Also on an existing file, it may be empty or half made
+    db.executescript(SCHEMA)
+    return db
+
+
+def describe(args):
+    """The details of a build setting that are kept with its runs."""
+    image = None
+    if args.d:
+        image = "%s:%s" % (os.path.basename(args.proj).lower(),
+                           os.path.basename(args.d).replace('.Dockerfile', '').lower())
+    return {'project': args.proj, 'build_name': args.build_name, 'image': image}
+
+
+def get_mode(args):
+    """What a bwd call did, from its command line."""
+    if args.jobs is not None:
+        return 'jobs'
+    if args.batch is not None:
+        return 'batch'
+    if args.watch:
+        return 'watch'
+    if args.s is not None:
+        return 'run'
+    return 'build'
+
+
+def _is_under(span, ancestor):
+    while span is not None:
+        if span is ancestor:
+            return True
+        span = span.parent
+    return False
+
+
+def _summarize(spans):
+    """Return the seconds of each phase and the bytes sent, of spans."""
+    phases = {}
+    payload = 0
+    for span in spans:
+        if span.name not in NOT_PHASES:
+            phases[span.name] = phases.get(span.name, 0) + span.duration
+        # Fetched outputs come back, they are not sent
+        if span.name != 'fetch_outputs':
+            payload += span.args.get('bytes', 0)
+    return phases, payload
+
+
+def get_records(tracer, exit_code):
+    """Turn the spans of a bwd call into the runs to keep, one per host.
+
+    Parameters
+    ----------
+    tracer : trace.Tracer
+        The spans of the call, under one 'bwd' span that has the
+        details of describe
+    exit_code : int
+        The exit code of the call, a host or the run may have its own
+
+    Returns
+    -------
+    list
+        A (run, phases) tuple per host, run is a dict of the columns of
+        the runs table and phases the {name: seconds} of the host
+    """
+    roots = [span for span in tracer.spans if span.parent is None and span.name == 'bwd']
+    if not roots or roots[0].args.get('build_name') is None:
+        # Nothing was run, e.g. -init or -daemon
+        return []
+    root = roots[0]
+    base = {
+        'started': root.start,
+        'project': root.args.get('project'),
+        'build_name': root.args.get('build_name'),
+        'host': root.args.get('host', LOCAL_HOST),
+        'image': root.args.get('image'),
+        'mode': root.args.get('mode'),
+        'exit_code': root.args.get('exit_code', exit_code),
+        'total_s': root.duration,
+    }
+
+    hosts = [span for span in tracer.spans if span.name == 'host']
+    if not hosts:
+        phases, payload = _summarize(tracer.spans)
+        return [(dict(base, payload_bytes=payload), phases)]
+
+    # The phases of the call that were not on one host count for all
+    shared = [span for span in tracer.spans
+              if not any(_is_under(span, host) for host in hosts)]
+    records = []
+    for host in hosts:
+        phases, payload = _summarize(
+            shared + [span for span in tracer.spans if _is_under(span, host)])
+        records.append((dict(base, host=host.args.get('host'), payload_bytes=payload,
+                             exit_code=host.args.get('exit_code', 0), total_s=host.duration),
+                        phases))
+    return records
+
+
+def record(tracer, exit_code, path=HISTORY_PATH):
+    """Keep the runs of this bwd call in the history, see get_records.
+
+    A history that can not be written is reported and skipped, it never
+    fails the run.
+    """
+    if not path:
+        return
+    records = get_records(tracer, exit_code)
+    if not records:
+        return
+    import sqlite3
+    try:
+        db = connect(path)
+        with db:
+            for run, phases in records:
+                columns = sorted(run)
+                cursor = db.execute("INSERT INTO runs (%s) VALUES (%s)" % (
+                    ', '.join(columns), ', '.join('?' * len(columns))),
+                    [run[column] for column in columns])
+                db.executemany("INSERT INTO phases (run_id, name, seconds) VALUES (?, ?, ?)",
+                               [(cursor.lastrowid, name, seconds)
+                                for name, seconds in sorted(phases.items())])
+        db.close()
+    except (sqlite3.Error, OSError) as e:
+        print("Could not record the run in %s: %s" % (path, e))
+
+
+def percentile(values, q):
+    """The q-th percentile of values, by the nearest rank."""
+    values = sorted(values)
+    return values[max(int(math.ceil(q / 100.0 * len(values))) - 1, 0)]
+
+
+def find_regressions(runs, phases):
+    """Compare the latest runs of one build setting on one host with the runs before.
+
+    Parameters
+    ----------
+    runs : list
+        (id, started, total_s, payload_bytes) of the successful runs,
+        oldest first
+    phases : dict
+        {run id: {phase: seconds}}
+
+    Returns
+    -------
+    list
+        (what, before, now) of every phase, or 'total', whose median
+        grew by REGRESSION_RATIO or more, before and now are the
+        medians in seconds
+    """
+    if len(runs) < RECENT_RUNS + MIN_BASELINE_RUNS:
+        return []
+    baseline, recent = runs[:-RECENT_RUNS], runs[-RECENT_RUNS:]
+
+    def values(subset, what):
+        if what == 'total':
+            return [run[2] for run in subset]
+        return [phases.get(run[0], {}).get(what, 0) for run in subset]
+
+    names = sorted(set(name for run in recent for name in phases.get(run[0], {})))
+    regressions = []
+    for what in ['total'] + names:
+        before = percentile(values(baseline, what), 50)
+        now = percentile(values(recent, what), 50)
+        if now >= MIN_PHASE_SECONDS and now > before * REGRESSION_RATIO:
+            regressions.append((what, before, now))
+    return regressions
+
+
+def _week(started):
+    """The monday of the week of a time, as YYYY-MM-DD."""
+    day = datetime.date.fromtimestamp(started)
+    return (day - datetime.timedelta(days=day.weekday())).isoformat()
+
+
+def _size(n_bytes):
+    """A byte count, in B, kB, MB or GB."""
+    if n_bytes < 1000:
+        return "%d B" % n_bytes
+    for unit in ('kB', 'MB'):
+        n_bytes /= 1000.0
+        if n_bytes < 1000:
+            return "%.1f %s" % (n_bytes, unit)
+    return "%.1f GB" % (n_bytes / 1000.0)
+
+
+def stats(days=30, project=None, build_name=None, path=HISTORY_PATH):
+    """Return a report of the recorded runs, with their percentiles per week.
+
+    Runs are grouped by project, build setting, host and what was run.
+    Every group lists the p50 and p90 of its total time per week, of
+    each of its phases, and the phases that got slower, see
+    find_regressions. Only runs that exited with 0 are timed.
+
+    Parameters
+    ----------
+    days : int, optional
+        How far back to look
+    project : str, optional
+        Only the runs of this project
+    build_name : str, optional
+        Only the runs of this build setting
+    path : str, optional
+        The history file
+    """
+    if not path or not os.path.exists(path):
+        return "No runs have been recorded%s" % (" in %s" % path if path else '')
+    db = connect(path)
+    query = "SELECT id, started, project, build_name, host, mode, total_s, payload_bytes, " \
+            "exit_code FROM runs WHERE started >= ?"
+    params = [time.time() - days * 86400]
+    if project:
+        query += " AND project = ?"
+        params.append(os.path.abspath(project))
+    if build_name:
+        query += " AND build_name = ?"
+        params.append(build_name)
+    rows = db.execute(query + " ORDER BY started", params).fetchall()
+    phases = {}
+    if rows:
+        for run_id, name, seconds in db.execute(
+                "SELECT run_id, name, seconds FROM phases WHERE run_id >= ?", [rows[0][0]]):
+            phases.setdefault(run_id, {})[name] = seconds
+    db.close()
+    if not rows:
+        return "No runs in the last %d days in %s" % (days, path)
+
+    groups = {}
+    for run_id, started, proj, name, host, mode, total, payload, exit_code in rows:
+        group = groups.setdefault((os.path.basename(proj or ''), name, host, mode),
+                                  {'runs': 0, 'failed': 0, 'ok': []})
+        group['runs'] += 1
+        if exit_code == 0:
+            group['ok'].append((run_id, started, total, payload))
+        else:
+            group['failed'] += 1
+
+    lines = ["Run history of the last %d days, %d runs, from %s" % (days, len(rows), path)]
+    flagged = []
+    for key in sorted(groups):
+        group = groups[key]
+        lines.append("")
+        lines.append("%s / %s @ %s (%s): %d runs, %d failed" % (
+            key[0], key[1], key[2], key[3], group['runs'], group['failed']))
+        ok = group['ok']
+        if not ok:
+            continue
+
+        weeks = {}
+        for run in ok:
+            weeks.setdefault(_week(run[1]), []).append(run)
+        lines.append("    %-12s %5s %10s %10s %12s" % ('Week of', 'Runs', 'p50', 'p90', 'p50 sent'))
+        for week, runs in sorted(weeks.items()):
+            totals = [run[2] for run in runs]
+            lines.append("    %-12s %5d %9.2fs %9.2fs %12s" % (
+                week, len(runs), percentile(totals, 50), percentile(totals, 90),
+                _size(percentile([run[3] or 0 for run in runs], 50))))
+
+        names = sorted(set(name for run in ok for name in phases.get(run[0], {})))
+        lines.append("    %-24s %10s %10s" % ('Phase', 'p50', 'p90'))
+        for name in names:
+            seconds = [phases.get(run[0], {}).get(name, 0) for run in ok]
+            lines.append("    %-24s %9.2fs %9.2fs" % (
+                name, percentile(seconds, 50), percentile(seconds, 90)))
+
+        for what, before, now in find_regressions(ok, phases):
+            flagged.append("%s / %s @ %s (%s): %s %.2fs -> %.2fs, %s" % (
+                key[0], key[1], key[2], key[3], what, before, now,
+                "%.1fx" % (now / before) if before else 'new'))
+
+    lines.append("")
+    if flagged:
+        lines.append("Regressions, the median of the last %d runs against the runs before:"
+                     % RECENT_RUNS)
+        lines.extend("    %s" % line for line in flagged)
+    else:
+        lines.append("No regressions")
+    return '\n'.join(lines)
+
+
+def exit_code(status):
+    """The exit code of a command, from the status os.system returned."""
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
@@ -0,0 +1,164 @@
+import os
+import re
+
+# Files the ignore patterns are read from, later files take precedence
+IGNORE_FILES = ['.dockerignore', '.bwdignore']
+GITIGNORE = '.gitignore'
+
+
+def _translate(pattern):
+    """Translate a gitignore style glob into a regular expression."""
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**':
+                i += 2
+                if pattern[i:i + 1] == '/':
+                    # '**/' matches zero or more folders
+                    res.append('(?:.*/)?')
+                    i += 1
+                else:
+                    res.append('.*')
+                continue
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 2)
+            if end == -1:
+                res.append(re.escape(c))
+            else:
+                content = pattern[i + 1:end].replace('\\', '\\\\')
+                if content[0] == '!':
+                    content = '^' + content[1:]
+                res.append('[%s]' % content)
+                i = end
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+
+class IgnoreRule():
+    """One compiled line of an ignore file."""
+    def __init__(self, pattern, anchored=False):
+        """Initialize class
+
+        Parameters
+        ----------
+        pattern : str
+            The line from the ignore file
+        anchored : bool, optional
+            Always match from the project root, as .dockerignore does.
+            Otherwise only patterns with a slash in them are anchored.
+
+        """
+        self.negate = pattern.startswith('!')
+        if self.negate:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if pattern.startswith('./'):
+            pattern = pattern[2:]
+        if '/' in pattern:
+            anchored = True
+        pattern = pattern.lstrip('/')
+
+        prefix = '^' if anchored else '(?:^|.*/)'
+        self._regex = re.compile(prefix + _translate(pattern) + '$')
+
+    def match(self, rel_path, is_dir=False):
+        if self.dir_only and not is_dir:
+            return False
+        return self._regex.match(rel_path) is not None
+
+
+def parse_lines(lines, anchored=False):
+    """Compile the lines of an ignore file into a list of IgnoreRule."""
+    rules = []
+    for line in lines:
+        line = line.rstrip('\n').rstrip('\r')
+        if not line.strip() or line.startswith('#'):
+            continue
+        # Trailing spaces are ignored unless escaped
+        if not line.endswith('\\ '):
+            line = line.rstrip(' ')
+        rules.append(IgnoreRule(line, anchored=anchored))
+    return rules
+
+
+class IgnoreFilter():
+    """Decides which project paths are left out of syncs and build contexts."""
+    def __init__(self, rules=None):
+        self._rules = rules or []
+
+    def add_file(self, path, anchored=False):
+        """Add the rules of an ignore file, if it exists."""
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r') as f:
+            self._rules += parse_lines(f, anchored=anchored)
+
+    def add_patterns(self, patterns, anchored=False):
+        """Add rules, one pattern each, in the syntax of an ignore file."""
+        self._rules += parse_lines(patterns, anchored=anchored)
+
+    def _match(self, rel_path, is_dir):
+        ignored = False
+        for rule in self._rules:
+            if ignored == rule.negate and rule.match(rel_path, is_dir):
+                ignored = not rule.negate
+        return ignored
+
+    def is_ignored(self, rel_path, is_dir=False):
+        """Check if rel_path, relative to the project root, is ignored.
+
+        A path inside an ignored folder is ignored as well, as in git.
+        """
+        rel_path = rel_path.replace(os.sep, '/')
+        parts = rel_path.split('/')
+        for i in range(1, len(parts)):
+            if self._match('/'.join(parts[:i]), True):
+                return True
+        return self._match(rel_path, is_dir)
+
+    def prune(self, rel_root, dirs, files):
+        """Remove ignored entries from an os.walk step, in place.
+
+        rel_root is the walked folder relative to the project root. Its
+        parents are assumed to have been checked already.
+        """
+        def rel(name):
+            return name if rel_root in ('', '.') else '%s/%s' % (rel_root.replace(os.sep, '/'), name)
+
+        dirs[:] = [d for d in dirs if not self._match(rel(d), True)]
+        files[:] = [f for f in files if not self._match(rel(f), False)]
+
+
+def load_ignore(proj_root, use_gitignore=False):
+    """Read the ignore files in the root of the project.
+
+    Parameters
+    ----------
+    proj_root : str
+        The root of the project
+    use_gitignore : bool, optional
+        Also read .gitignore, only the one in the project root is used.
+
+    Returns
+    -------
+    IgnoreFilter
+        Filter built from .gitignore, .dockerignore and .bwdignore
+    """
+    ignore = IgnoreFilter()
+    if use_gitignore:
+        ignore.add_file(os.path.join(proj_root, GITIGNORE))
+    for name in IGNORE_FILES:
+        # Docker always matches .dockerignore patterns from the root
+        ignore.add_file(os.path.join(proj_root, name), anchored=name == '.dockerignore')
+    return ignore
@@ -0,0 +1,205 @@
+import os
+import copy
+import time
+import shlex
+import threading
+import collections
+
+from . import custom_exceptions as ce
+from . import daemon
+from . import trace
+from . import utils
+
+# Asked which GPUs are in use, a stand-in script can be given for tests
+NVIDIA_SMI = os.environ.get('BWD_NVIDIA_SMI', 'nvidia-smi')
+# A GPU with more memory in use than this (MiB) is taken by someone else
+BUSY_MEMORY_MB = 500
+# Seconds between two checks of a GPU that is taken by someone else
+POLL_SECONDS = 10
+
+Job = collections.namedtuple('Job', ['script', 'args'])
+
+
+def read_jobs(path):
+    """Read a job file, one script and its arguments per line.
+
+    Empty lines and lines starting with # are skipped. Scripts are
+    relative to the folder of the job file.
+
+    Returns
+    -------
+    list
+        A Job for every line
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = shlex.split(line)
+            jobs.append(Job(os.path.join(folder, parts[0]), parts[1:]))
+    return jobs
+
+
+def query_gpus(ssh_user=None, ssh_ip=None):
+    """Ask nvidia-smi how much memory each GPU uses.
+
+    Returns
+    -------
+    dict
+        Memory used in MiB per GPU index, None if nvidia-smi could not tell
+    """
+    cmd = "%s --query-gpu=index,memory.used --format=csv,noheader,nounits" % NVIDIA_SMI
+    if ssh_ip is not None:
+        from .ssh_utils import append_ssh
+        cmd = append_ssh(ssh_user, ssh_ip, cmd)
+    import subprocess
+    try:
+        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+
+    used = {}
+    for line in output.decode().splitlines():
+        try:
+            index, memory = [int(value) for value in line.split(',')]
+        except ValueError:
+            continue
+        used[index] = memory
+    return used
+
+
+class GpuScheduler():
+    """Runs a queue of jobs, each on one free GPU of a pool.
+
+    There is one worker per GPU. A worker waits until nvidia-smi says
+    its GPU is free, takes the next job, runs it and starts over, until
+    the queue is empty.
+    """
+    def __init__(self, args, ssh_result=None):
+        """Initialize class
+
+        Parameters
+        ----------
+        args : Namespace
+            The build setting, see config.get_build_setting, its gpu
+            list is the pool
+        ssh_result : str, optional
+            The folder the project was sent to, if it runs on a remote
+
+        """
+        if not args.gpu:
+            raise ce.NoGpusConfigured()
+        self._args = args
+        self._ssh_result = ssh_result
+        self._pool = [int(gpu) for gpu in utils.get_as_list(args.gpu)]
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        # Set once every job was taken, so waiting workers stop
+        self._drained = threading.Event()
+        self._nvidia_smi_missing = False
+        self.results = []
+
+    def _remote(self):
+        return (self._args.ssh_user, self._args.ssh_ip) if self._ssh_result else (None, None)
+
+    def is_free(self, gpu):
+        """Check if no one else uses gpu, every GPU is free without nvidia-smi."""
+        used = query_gpus(*self._remote())
+        if used is None:
+            if not self._nvidia_smi_missing:
+                print("Could not ask %s which GPUs are in use, using all of %s" % (
+                    NVIDIA_SMI, self._pool))
+                self._nvidia_smi_missing = True
+            return True
+        return used.get(gpu, 0) < BUSY_MEMORY_MB
+
+    def get_command(self, job, gpu):
+        """Return the shell command that runs job on gpu."""
+        job_args = copy.copy(self._args)
+        job_args.s = job.script
+        job_args.script_args = job.args
+        job_args.gpu = [gpu]
+        command = daemon.get_command(job_args, self._ssh_result)
+        if self._ssh_result is not None:
+            from .ssh_utils import append_ssh
+            command = append_ssh(self._args.ssh_user, self._args.ssh_ip, shlex.quote(command))
+        return command
+
+    def _next_job(self):
+        with self._lock:
+            job = self._queue.popleft() if self._queue else None
+            if not self._queue:
+                self._drained.set()
+            return job
+
+    def _work(self, gpu):
+        while not self._drained.is_set():
+            if not self.is_free(gpu):
+                self._drained.wait(POLL_SECONDS)
+                continue
+            job = self._next_job()
+            if job is None:
+                return
+            self._run(job, gpu)
+
+    def _run(self, job, gpu):
+        name = ' '.join([os.path.relpath(job.script, self._args.proj)] + job.args)
+        start = time.time()
+        returncode = 0
+        with trace.span('job', job=name, gpu=gpu) as span:
+            try:
+                utils.run_and_stream(
+                    "sh -c %s" % shlex.quote(self.get_command(job, gpu)),
+                    debug=True, prefix='[gpu %d] ' % gpu)
+            except ce.CommandFailed as e:
+                returncode = e.returncode
+            except Exception as e:
+                # The job could not start, e.g. its script does not exist
+                print("[gpu %d] Could not run %s: %s" % (gpu, name, e))
+                returncode = -1
+            span.add(returncode=returncode)
+        with self._lock:
+            self.results.append({
+                'job': name,
+                'gpu': gpu,
+                'returncode': returncode,
+                'seconds': time.time() - start,
+            })
+
+    def run(self, jobs):
+        """Run every job, as many at the same time as there are GPUs.
+
+        Returns
+        -------
+        list
+            A dict with the job, gpu, returncode and seconds of every
+            job, in the order they finished
+
+        Raises
+        ------
+        ce.JobsFailed
+            Some jobs exited with an error
+        """
+        self._queue.extend(jobs)
+        self._drained.clear()
+        print("Running %d jobs on GPUs %s" % (len(jobs), ', '.join(str(g) for g in self._pool)))
+        # The jobs show up under the span and output prefix of the caller
+        work = utils.in_caller_context(self._work)
+        workers = [threading.Thread(target=work, args=(gpu,), daemon=True) for gpu in self._pool]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        print("Job summary:")
+        for result in self.results:
+            print("\tgpu %-3d %-40s exit %-4d %7.1fs" % (
+                result['gpu'], result['job'], result['returncode'], result['seconds']))
+
+        failed = [result['job'] for result in self.results if result['returncode'] != 0]
+        if failed:
+            raise ce.JobsFailed(failed)
+        return self.results
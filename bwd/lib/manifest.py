@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import threading
+
+# Folder (relative to the project root) where bwd keeps its own state
+STATE_DIR = '.bwd'
+MANIFEST_NAME = 'manifest.json'
+
+
+def hash_file(path, block_size=1 << 20):
+    """Return the sha1 hex digest of a file."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def walk_project(proj_root, ignore=None):
+    """Yield the relative path of every file in the project.
+
+    The bwd state folder is never part of the project.
+
+    Parameters
+    ----------
+    proj_root : str
+        The root of the project
+    ignore : IgnoreFilter, optional
+        Ignored folders are not descended into, ignored files are skipped
+    """
+    for root, dirs, files in os.walk(proj_root):
+        if root == proj_root and STATE_DIR in dirs:
+            dirs.remove(STATE_DIR)
+        if ignore is not None:
+            ignore.prune(os.path.relpath(root, proj_root), dirs, files)
+        for file in files:
+            yield os.path.relpath(os.path.join(root, file), proj_root)
+
+
+def build_manifest(proj_root, previous=None, ignore=None):
+    """Create a {relative path: [size, mtime, sha1]} manifest of the project.
+
+    Parameters
+    ----------
+    proj_root : str
+        The root of the project
+    previous : dict, optional
+        An older manifest of the same project. Files whose size and
+        mtime did not change reuse the old hash instead of being re-read.
+    ignore : IgnoreFilter, optional
+        Files to leave out of the manifest
+
+    Returns
+    -------
+    dict
+        The manifest
+    """
+    previous = previous or {}
+    manifest = {}
+    for rel_path in walk_project(proj_root, ignore=ignore):
+        full_path = os.path.join(proj_root, rel_path)
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            # Broken symlink or file removed while walking
+            continue
+        old = previous.get(rel_path)
+        if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime:
+            digest = old[2]
+        else:
+            digest = hash_file(full_path)
+        manifest[rel_path] = [stat.st_size, stat.st_mtime, digest]
+
+    return manifest
+
+
+def diff_manifests(old, new):
+    """Compare two manifests by content.
+
+    Returns
+    -------
+    tuple
+        (changed, removed) where changed are the files in new that are
+        missing or different in old, and removed are the files only in old.
+    """
+    changed = sorted(
+        rel_path for rel_path, entry in new.items()
+        if rel_path not in old or old[rel_path][2] != entry[2])
+    removed = sorted(rel_path for rel_path in old if rel_path not in new)
+    return changed, removed
+
+
+def local_manifest_path(proj_root):
+    return os.path.join(proj_root, STATE_DIR, MANIFEST_NAME)
+
+
+def load_manifest(path):
+    """Load a manifest from disk, return None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    """Write manifest to path, replacing it in one step.
+
+    Runs on several hosts at the same time save the same manifest, a
+    reader never sees a half written file.
+    """
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
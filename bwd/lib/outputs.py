@@ -0,0 +1,265 @@
+import os
+import zlib
+import shlex
+import hashlib
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import custom_exceptions as ce
+from . import ignore as ig
+from . import manifest as mf
+from . import trace
+from . import utils
+
+# Streams that fetch outputs at the same time
+MAX_PARALLEL_FETCHES = 4
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_filter(patterns):
+    """Return an IgnoreFilter matching the outputs patterns, None if there are none.
+
+    The patterns of "outputs" follow the .gitignore syntax, e.g.
+    ``checkpoints/`` or ``*.log``.
+    """
+    if not patterns:
+        return None
+    outputs = ig.IgnoreFilter()
+    outputs.add_patterns(patterns)
+    return outputs
+
+
+def list_remote_files(ssh_user, ssh_ip, remote_dir):
+    """Return the {relative path: (size, mtime)} of the files in a remote folder.
+
+    The bwd state folder is left out, mtime is in whole seconds.
+    """
+    from .ssh_utils import append_ssh
+    script = "cd %s && find . -path ./%s -prune -o -type f -printf '%%s %%T@ %%P\\n'" % (
+        remote_dir, mf.STATE_DIR)
+    command = append_ssh(ssh_user, ssh_ip, shlex.quote(script))
+    try:
+        output = subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return {}
+
+    files = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split(' ', 2)
+        if len(fields) == 3 and fields[0].isdigit():
+            files[fields[2]] = (int(fields[0]), int(float(fields[1])))
+    return files
+
+
+def plan_fetch(remote_files, proj_root, outputs):
+    """Decide what to fetch of the remote files that are outputs.
+
+    A file whose local copy has the same size and mtime is up to date.
+    A file that grew may only need its new end, see check_appended.
+
+    Returns
+    -------
+    tuple
+        (full, grown) the paths to fetch whole, and (path, local size)
+        of the files that grew
+    """
+    full = []
+    grown = []
+    for path, (size, mtime) in sorted(remote_files.items()):
+        if not outputs.is_ignored(path):
+            continue
+        try:
+            stat = os.stat(os.path.join(proj_root, path))
+        except OSError:
+            full.append(path)
+            continue
+        if stat.st_size == size and int(stat.st_mtime) == mtime:
+            continue
+        if 0 < stat.st_size < size:
+            grown.append((path, stat.st_size))
+        else:
+            full.append(path)
+    return full, grown
+
+
+def check_appended(ssh_user, ssh_ip, remote_dir, proj_root, grown):
+    """Return the grown files whose local copy is the start of the remote one.
+
+    The sha1 of the first bytes of every remote file is asked for in
+    one round trip, files that were not only appended to are left out.
+    """
+    from .ssh_utils import append_ssh
+    if not grown:
+        return []
+    script = "cd %s && %s" % (remote_dir, '; '.join(
+        "head -c %d %s | sha1sum" % (size, shlex.quote(path)) for path, size in grown))
+    command = append_ssh(ssh_user, ssh_ip, shlex.quote(script))
+    try:
+        output = subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return []
+
+    digests = [line.split()[0] for line in output.decode().splitlines() if line.strip()]
+    appended = []
+    for (path, size), digest in zip(grown, digests):
+        sha = hashlib.sha1()
+        with open(os.path.join(proj_root, path), 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha.update(block)
+        if sha.hexdigest() == digest:
+            appended.append((path, size))
+    return appended
+
+
+def fetch_files(ssh_user, ssh_ip, remote_dir, proj_root, files):
+    """Fetch whole files into the project, as one compressed tar stream.
+
+    The tar on the remote is given the file list on its stdin, and its
+    output is piped into a tar here that extracts into proj_root.
+    """
+    from .ssh_utils import append_ssh
+    remote = append_ssh(ssh_user, ssh_ip, shlex.quote(
+        "cd %s && tar --null -czf - -T -" % remote_dir))
+    local = "tar -xzf - -C %s" % shlex.quote(proj_root)
+    sender = subprocess.Popen(shlex.split(remote), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    receiver = subprocess.Popen(shlex.split(local), stdin=sender.stdout)
+    # The stream is the receiver's to read, and to close
+    sender.stdout.close()
+    try:
+        sender.stdin.write('\0'.join(files).encode())
+    except BrokenPipeError:
+        # The sender failed, its exit code tells
+        pass
+    finally:
+        sender.stdin.close()
+
+    if sender.wait() != 0:
+        receiver.wait()
+        raise ce.CommandFailed(sender.returncode, remote, [])
+    if receiver.wait() != 0:
+        raise ce.CommandFailed(receiver.returncode, local, [])
+
+
+def fetch_end(ssh_user, ssh_ip, remote_dir, proj_root, path, offset, mtime):
+    """Append what a remote file has past offset to the local copy, compressed."""
+    from .ssh_utils import append_ssh
+    command = append_ssh(ssh_user, ssh_ip, shlex.quote("tail -c +%d %s | gzip -c" % (
+        offset + 1, shlex.quote(os.path.join(remote_dir, path)))))
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    local_path = os.path.join(proj_root, path)
+    with open(local_path, 'ab') as f:
+        for block in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+            trace.add(bytes=len(block))
+            f.write(gunzip.decompress(block))
+        f.write(gunzip.flush())
+    if process.wait() != 0:
+        raise ce.CommandFailed(process.returncode, command, [])
+    os.utime(local_path, (mtime, mtime))
+
+
+def _split(files, sizes, n_groups):
+    """Split files in at most n_groups groups of about the same size."""
+    groups = [[] for _ in range(max(min(n_groups, len(files)), 1))]
+    totals = [0] * len(groups)
+    for path in sorted(files, key=lambda p: -sizes[p]):
+        i = totals.index(min(totals))
+        groups[i].append(path)
+        totals[i] += sizes[path]
+    return [group for group in groups if group]
+
+
+def fetch_outputs(args, remote_dir, max_parallel=MAX_PARALLEL_FETCHES):
+    """Bring the outputs of the runs in remote_dir back into the project.
+
+    Only outputs that are new or changed since the last fetch are sent.
+    Files that grew, e.g. logs, are only sent their new end. Several
+    streams fetch at the same time.
+
+    Parameters
+    ----------
+    args : Namespace
+        The build setting, with the "outputs" patterns
+    remote_dir : str
+        The folder the project was sent to, see maybe_send
+    max_parallel : int, optional
+        How many streams fetch at the same time
+
+    Returns
+    -------
+    int
+        How many files were fetched
+    """
+    outputs = get_filter(args.outputs)
+    if outputs is None or remote_dir is None:
+        return 0
+
+    with trace.span('fetch_outputs') as span:
+        remote_files = list_remote_files(args.ssh_user, args.ssh_ip, remote_dir)
+        full, grown = plan_fetch(remote_files, args.proj, outputs)
+        appended = check_appended(
+            args.ssh_user, args.ssh_ip, remote_dir, args.proj, grown)
+        appended_paths = set(path for path, _ in appended)
+        full += [path for path, _ in grown if path not in appended_paths]
+        span.add(files=len(full), appended=len(appended))
+        if not full and not appended:
+            return 0
+
+        sizes = {path: remote_files[path][0] for path in full}
+        jobs = [lambda group=group: fetch_files(
+            args.ssh_user, args.ssh_ip, remote_dir, args.proj, group)
+            for group in _split(full, sizes, max_parallel)]
+        jobs += [lambda path=path, offset=offset: fetch_end(
+            args.ssh_user, args.ssh_ip, remote_dir, args.proj, path, offset,
+            remote_files[path][1])
+            for path, offset in appended]
+
+        @utils.in_caller_context
+        def run_job(job):
+            job()
+
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            list(executor.map(run_job, jobs))
+
+    print("%sFetched %d outputs, %d of them only their new end" % (
+        utils.get_prefix(), len(full) + len(appended), len(appended)))
+    return len(full) + len(appended)
+
+
+@contextlib.contextmanager
+def fetching(args, remote_dir):
+    """Fetch the outputs every "outputs_interval" seconds in the block, and after it.
+
+    Nothing is fetched without "outputs", or when running locally.
+    """
+    if not args.outputs or remote_dir is None:
+        yield
+        return
+
+    done = threading.Event()
+
+    def fetch():
+        try:
+            fetch_outputs(args, remote_dir)
+        except Exception as e:
+            # The next fetch tries again
+            print("%sFetching the outputs failed: %s" % (utils.get_prefix(), e))
+
+    @utils.in_caller_context
+    def poll():
+        while not done.wait(args.outputs_interval):
+            fetch()
+
+    poller = None
+    if args.outputs_interval:
+        poller = threading.Thread(target=poll, daemon=True)
+        poller.start()
+    try:
+        yield
+    finally:
+        done.set()
+        if poller is not None:
+            poller.join()
+        fetch()
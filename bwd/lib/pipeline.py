@@ -0,0 +1,125 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import custom_exceptions as ce
+from . import trace
+from . import utils
+
+# Stages of a pipeline that run at the same time
+MAX_PARALLEL_STAGES = 4
+
+
+class Pipeline():
+    """Stages of a run, each starts as soon as the stages it needs are done.
+
+    Every stage is a function of the results of the stages before it,
+    stages that do not need each other run at the same time.
+    """
+    def __init__(self, max_parallel=MAX_PARALLEL_STAGES):
+        """Initialize class
+
+        Parameters
+        ----------
+        max_parallel : int, optional
+            How many stages may run at the same time
+
+        """
+        self._max_parallel = max_parallel
+        self._stages = {}
+        self._order = []
+        # (start, end) of every stage that ran
+        self.timings = {}
+
+    def add(self, name, func, needs=()):
+        """Add a stage, func gets a dict with the result of every stage so far.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, also the name of its trace span
+        func : callable
+            Does the work of the stage, its return value is the result
+        needs : tuple, optional
+            Names of the stages that must be done before this one starts
+        """
+        self._stages[name] = (func, tuple(needs))
+        self._order.append(name)
+
+    def run(self):
+        """Run every stage, return a dict with the result of each.
+
+        When a stage fails no new stages start, the running ones are
+        waited for and the error of the first failed stage is raised.
+
+        Raises
+        ------
+        ce.CircularStages
+            Some stages need each other, or a stage that was not added
+        """
+        results = {}
+        todo = list(self._order)
+        running = {}
+        error = None
+
+        @utils.in_caller_context
+        def timed_stage(name):
+            func = self._stages[name][0]
+            start = time.time()
+            try:
+                with trace.span(name):
+                    return func(dict(results))
+            finally:
+                self.timings[name] = (start, time.time())
+
+        with ThreadPoolExecutor(max_workers=self._max_parallel) as executor:
+            while (todo and error is None) or running:
+                if error is None:
+                    for name in list(todo):
+                        if all(need in results for need in self._stages[name][1]):
+                            running[executor.submit(timed_stage, name)] = name
+                            todo.remove(name)
+
+                if not running:
+                    raise ce.CircularStages(todo)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        error = error or e
+
+        if error is not None:
+            raise error
+        return results
+
+    def critical_path(self):
+        """Return the chain of stages that the run waited on, first stage first.
+
+        It ends with the stage that finished last, and goes back each
+        time through the needed stage that finished last. Making any
+        other stage faster would not make the run shorter.
+        """
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while True:
+            needs = [need for need in self._stages[name][1] if need in self.timings]
+            if not needs:
+                break
+            name = max(needs, key=lambda n: self.timings[n][1])
+            path.append(name)
+        return list(reversed(path))
+
+    def report(self):
+        """Describe the critical path, with the seconds of each stage on it."""
+        path = self.critical_path()
+        if not path:
+            return "No stages ran"
+        start = min(start for start, _ in self.timings.values())
+        end = self.timings[path[-1]][1]
+        return "Critical path (%.2fs): %s" % (end - start, ' -> '.join(
+            '%s %.2fs' % (name, self.timings[name][1] - self.timings[name][0])
+            for name in path))
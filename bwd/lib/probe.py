@@ -0,0 +1,218 @@
+import os
+import shlex
+import threading
+import subprocess
+
+from . import trace
+
+# Sections of the probe output
+_SECTIONS = ('dockerfiles', 'images', 'disk', 'gpus')
+
+# One probe per (ssh_user, ssh_ip, project_dir), for the rest of the run
+_states = {}
+# Dockerfiles a sync put in a project folder, by (ssh_user, ssh_ip, project_dir)
+_synced = {}
+# Images changed on a host during the run, by (ssh_user, ssh_ip), so a
+# probe that was already running when they changed does not trust them
+_forgotten = {}
+_lock = threading.Lock()
+
+
+class RemoteState():
+    """What a remote host looked like when it was probed, see probe."""
+    def __init__(self, project_dir, dockerfiles=None, images=None, disk_free_kb=None, gpus=None):
+        """Initialize class
+
+        Parameters
+        ----------
+        project_dir : str
+            The project folder on the remote host
+        dockerfiles : dict, optional
+            sha1 of each Dockerfile by name, None if there is no
+            Dockerfiles folder
+        images : dict, optional
+            Image id by repository:tag
+        disk_free_kb : int, optional
+            Free disk space where the project lives
+        gpus : list, optional
+            A dict with the index, memory_used, memory_total (MiB) and
+            name of each GPU, empty without nvidia-smi
+
+        """
+        self.project_dir = project_dir
+        self.dockerfiles = dockerfiles
+        self.images = images or {}
+        self.disk_free_kb = disk_free_kb
+        self.gpus = gpus or []
+        # Images built since the probe, their ids are out of date
+        self._stale = set()
+
+    def image_id(self, image):
+        """Return (known, id) of image, id is None if the image does not exist.
+
+        known is False if the probe can not tell, e.g. the image was
+        built since, it must then be asked for.
+        """
+        if '@' in image or image in self._stale:
+            return False, None
+        if ':' not in image.rsplit('/', 1)[-1]:
+            image = '%s:latest' % image
+        return True, self.images.get(image)
+
+    def forget_image(self, image):
+        self._stale.add(image)
+
+
+def _probe_script(project_dir, disk_dir):
+    """A shell script that prints every section of a RemoteState."""
+    dockerfiles = os.path.join(project_dir, 'Dockerfiles')
+    return "; ".join([
+        "echo @@dockerfiles",
+        "[ -d %s ] && (cd %s && for f in *; do [ -f \"$f\" ] && sha1sum \"$f\"; done; "
+        "echo @@present)" % (dockerfiles, dockerfiles),
+        "echo @@images",
+        "docker images --no-trunc --format %s 2>/dev/null" % shlex.quote(
+            '{{.Repository}}:{{.Tag}} {{.ID}}'),
+        "echo @@disk",
+        "df -Pk %s 2>/dev/null | tail -n 1" % disk_dir,
+        "echo @@gpus",
+        "nvidia-smi --query-gpu=index,memory.used,memory.total,name "
+        "--format=csv,noheader,nounits 2>/dev/null",
+        "true",
+    ])
+
+
+def parse_probe(project_dir, output):
+    """Turn the output of the probe script into a RemoteState."""
+    lines = {section: [] for section in _SECTIONS}
+    section = None
+    for line in output.splitlines():
+        if line.startswith('@@') and line[2:] in _SECTIONS:
+            section = line[2:]
+        elif section is not None and line.strip():
+            lines[section].append(line.strip())
+
+    dockerfiles = None
+    if '@@present' in lines['dockerfiles']:
+        dockerfiles = {}
+        for line in lines['dockerfiles']:
+            digest, _, name = line.partition('  ')
+            if name:
+                dockerfiles[name] = digest
+
+    images = {}
+    for line in lines['images']:
+        tag, _, image_id = line.partition(' ')
+        if '<none>' not in tag and image_id:
+            images[tag] = image_id
+
+    disk_free_kb = None
+    if lines['disk']:
+        fields = lines['disk'][-1].split()
+        if len(fields) >= 4 and fields[3].isdigit():
+            disk_free_kb = int(fields[3])
+
+    gpus = []
+    for line in lines['gpus']:
+        fields = [field.strip() for field in line.split(',')]
+        try:
+            gpus.append({
+                'index': int(fields[0]),
+                'memory_used': int(fields[1]),
+                'memory_total': int(fields[2]),
+                'name': fields[3],
+            })
+        except (IndexError, ValueError):
+            continue
+
+    return RemoteState(project_dir, dockerfiles, images, disk_free_kb, gpus)
+
+
+def probe(project_dir, ssh_user, ssh_ip, disk_dir=None):
+    """Ask a remote host about the project, its images, disk and GPUs at once.
+
+    The answer is kept for the rest of the run, later calls for the
+    same project and host return it without asking again.
+
+    Parameters
+    ----------
+    project_dir : str
+        The project folder on the remote host
+    ssh_user : str
+        The user to ssh to
+    ssh_ip : str
+        Ip of the workstation
+    disk_dir : str, optional
+        Folder to tell the free disk space of, project_dir by default
+
+    Returns
+    -------
+    RemoteState
+        What the remote host looks like
+    """
+    key = (ssh_user, ssh_ip, project_dir)
+    with _lock:
+        if key in _states:
+            return _states[key]
+
+    from .ssh_utils import append_ssh
+    script = _probe_script(project_dir, disk_dir or project_dir)
+    command = append_ssh(ssh_user, ssh_ip, shlex.quote(script))
+    with trace.span('probe', host=ssh_ip):
+        try:
+            output = subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            output = b''
+    state = parse_probe(project_dir, output.decode('utf-8', 'replace'))
+
+    with _lock:
+        if key in _synced:
+            state.dockerfiles = _synced[key]
+        for image in _forgotten.get((ssh_user, ssh_ip), ()):
+            state.forget_image(image)
+        return _states.setdefault(key, state)
+
+
+def image_id(ssh_user, ssh_ip, image):
+    """Return (known, id) of image on a host, from the probes of this run.
+
+    known is False if no probe can tell, see RemoteState.image_id.
+    """
+    with _lock:
+        states = [state for (user, ip, _), state in _states.items()
+                  if (user, ip) == (ssh_user, ssh_ip)]
+    for state in states:
+        known, found = state.image_id(image)
+        if known:
+            return known, found
+    return False, None
+
+
+def forget_image(ssh_user, ssh_ip, image):
+    """Mark image as changed since the probes of a host, e.g. after a build."""
+    with _lock:
+        _forgotten.setdefault((ssh_user, ssh_ip), set()).add(image)
+        for (user, ip, _), state in _states.items():
+            if (user, ip) == (ssh_user, ssh_ip):
+                state.forget_image(image)
+
+
+def synced(ssh_user, ssh_ip, project_dir, manifest):
+    """Tell the probes that a sync made project_dir hold the files of manifest.
+
+    A probe that ran while the project was syncing saw the Dockerfiles
+    of before, they are replaced by the ones in manifest, also for a
+    probe that is still running.
+    """
+    dockerfiles = {}
+    for path, (_, _, digest) in manifest.items():
+        folder, name = os.path.split(path)
+        if folder == 'Dockerfiles':
+            dockerfiles[name] = digest
+    dockerfiles = dockerfiles or None
+
+    key = (ssh_user, ssh_ip, project_dir)
+    with _lock:
+        _synced[key] = dockerfiles
+        if key in _states:
+            _states[key].dockerfiles = dockerfiles
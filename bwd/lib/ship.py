@@ -0,0 +1,190 @@
+import os
+import io
+import json
+import shlex
+import hashlib
+import tarfile
+import tempfile
+import subprocess
+
+from . import custom_exceptions as ce
+from . import probe
+from . import trace
+from .build_cache import inspect_image
+from .ssh_utils import append_ssh, run_system_command
+
+# The local docker CLI, a stand-in can be given for tests
+DOCKER = os.environ.get('BWD_DOCKER', 'docker')
+# Layers up to this size are held in memory while they are hashed
+SPOOL_SIZE = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class _Chunks():
+    """A file object that keeps what is written, for a tarfile to stream into."""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def local_image(image):
+    """Return the id and the layer diff ids, bottom first, of a local image.
+
+    Raises
+    ------
+    ce.ImageMissing
+        There is no such image
+    """
+    command = "%s image inspect -f %s %s" % (
+        DOCKER, shlex.quote('{{.Id}} {{json .RootFS.Layers}}'), image)
+    try:
+        output = subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        raise ce.ImageMissing(image)
+    image_id, _, layers = output.decode().strip().partition(' ')
+    return image_id, json.loads(layers or '[]')
+
+
+def remote_layer_chains(ssh_user, ssh_ip):
+    """Return every chain of layers the remote docker daemon has.
+
+    Returns
+    -------
+    set
+        Tuples of diff ids, bottom first, one for every image layer and
+        the layers below it
+    """
+    script = "docker images -q --no-trunc | sort -u | xargs -r docker image inspect -f %s" % (
+        shlex.quote('{{json .RootFS.Layers}}'))
+    command = append_ssh(ssh_user, ssh_ip, shlex.quote(script))
+    try:
+        output = subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return set()
+
+    chains = set()
+    for line in output.decode().splitlines():
+        try:
+            layers = json.loads(line) or []
+        except ValueError:
+            continue
+        for i in range(len(layers)):
+            chains.add(tuple(layers[:i + 1]))
+    return chains
+
+
+def layers_to_skip(layers, chains):
+    """Return the diff ids of layers a daemon with chains already has.
+
+    docker load only reads a layer when the daemon lacks it and every
+    layer below it, so a layer can be left out if that whole chain is
+    known. A layer used more than once is kept if any use needs it.
+    """
+    needed = set()
+    known = set()
+    for i, layer in enumerate(layers):
+        if tuple(layers[:i + 1]) in chains:
+            known.add(layer)
+        else:
+            needed.add(layer)
+    return known - needed
+
+
+def iter_image_save(image, skip=()):
+    """Stream ``docker save image`` with the layers in skip left empty.
+
+    Layers are told apart by the sha256 of their content, their diff
+    id, so this works for the legacy and the OCI layout of docker save.
+
+    Parameters
+    ----------
+    image : str
+        The local image to save
+    skip : set, optional
+        Diff ids of the layers to send empty
+
+    Yields
+    ------
+    bytes
+        The tar, a valid input for ``docker load``
+    """
+    save = subprocess.Popen([DOCKER, 'save', image], stdout=subprocess.PIPE)
+    out = _Chunks()
+    src = tarfile.open(fileobj=save.stdout, mode='r|')
+    dst = tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT)
+    for member in src:
+        content = src.extractfile(member) if member.isfile() else None
+        if content is None:
+            dst.addfile(member)
+        else:
+            sha = hashlib.sha256()
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+                for block in iter(lambda: content.read(CHUNK_SIZE), b''):
+                    sha.update(block)
+                    spool.write(block)
+                if 'sha256:%s' % sha.hexdigest() in skip:
+                    member.size = 0
+                    dst.addfile(member, io.BytesIO())
+                else:
+                    spool.seek(0)
+                    dst.addfile(member, spool)
+        for chunk in out.drain():
+            yield chunk
+    dst.close()
+    for chunk in out.drain():
+        yield chunk
+
+    if save.wait() != 0:
+        raise ce.CommandFailed(save.returncode, '%s save %s' % (DOCKER, image), [])
+
+
+def ship_image(image, ssh_user, ssh_ip):
+    """Send a local image to the docker daemon of a remote host.
+
+    Only the layers the remote does not have are sent. The image is
+    not sent at all if the remote has the same image id already.
+
+    Parameters
+    ----------
+    image : str
+        Name of the local image
+    ssh_user : str
+        The user to ssh to
+    ssh_ip : str
+        Ip of the workstation
+
+    Raises
+    ------
+    ce.ImageMissing
+        There is no such local image
+    """
+    local_id, layers = local_image(image)
+    known, remote_id = probe.image_id(ssh_user, ssh_ip, image)
+    if not known:
+        remote_id = inspect_image(image, ssh_user, ssh_ip)
+    if remote_id == local_id:
+        print("%s is up to date on %s" % (image, ssh_ip))
+        return
+
+    skip = layers_to_skip(layers, remote_layer_chains(ssh_user, ssh_ip))
+    print("Sending %s to %s, %d of %d layers are there already" % (
+        image, ssh_ip, len(skip), len(set(layers))))
+
+    command = append_ssh(ssh_user, ssh_ip, "docker load")
+    with trace.span('ship_image', image=image, layers=len(set(layers)), skipped=len(skip)):
+        try:
+            run_system_command(command, stdin=trace.counted(iter_image_save(image, skip)))
+        except ce.CommandFailed:
+            if not skip:
+                raise
+            # The daemon may want every layer, e.g. with the containerd store
+            print("Loading %s without its shared layers failed, sending all of them" % image)
+            run_system_command(command, stdin=trace.counted(iter_image_save(image)))
+    probe.forget_image(ssh_user, ssh_ip, image)
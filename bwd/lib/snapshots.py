@@ -0,0 +1,158 @@
+import os
+import time
+import subprocess
+
+from . import manifest as mf
+from . import trace
+from .ssh_utils import (append_ssh, read_remote_json, write_remote_json, read_remote_manifest,
+                        run_system_command, sync_project)
+
+# The snapshots bwd made of a project, kept in the .bwd folder of its workspace
+SNAPSHOTS_NAME = 'snapshots.json'
+# Snapshots kept on the remote, unless the build setting says otherwise
+KEEP_SNAPSHOTS = 5
+
+
+def _registry_path(workspace):
+    return os.path.join(workspace, mf.STATE_DIR, SNAPSHOTS_NAME)
+
+
+def snapshot_sizes(ssh_user, ssh_ip, paths):
+    """Ask the remote how much disk each snapshot takes, in KiB.
+
+    Files that are hardlinked between snapshots are counted once, for
+    the first snapshot in paths that has them. Given the newest first,
+    the size of a snapshot is what removing it would free.
+
+    Returns
+    -------
+    dict
+        KiB per path, snapshots that no longer exist are left out
+    """
+    if not paths:
+        return {}
+    command = append_ssh(ssh_user, ssh_ip, "'du -sk %s 2>/dev/null; true'" % ' '.join(paths))
+    output = subprocess.check_output(command, shell=True).decode()
+    sizes = {}
+    for line in output.splitlines():
+        size, _, path = line.partition('\t')
+        if size.isdigit():
+            sizes[path] = int(size)
+    return sizes
+
+
+def collect_garbage(ssh_user, ssh_ip, snapshots, keep=KEEP_SNAPSHOTS, budget_mb=None):
+    """Remove the least recently used snapshots beyond keep, or beyond budget_mb.
+
+    The most recently used snapshot is always kept.
+
+    Parameters
+    ----------
+    ssh_user : str
+        The user to ssh to
+    ssh_ip : str
+        Ip of the workstation
+    snapshots : list
+        Entries of the snapshot registry, see send_snapshot
+    keep : int, optional
+        How many snapshots to keep at most
+    budget_mb : float, optional
+        How much disk the kept snapshots may take together
+
+    Returns
+    -------
+    list
+        The entries of the snapshots that were kept
+    """
+    by_use = sorted(snapshots, key=lambda s: s['last_used'], reverse=True)
+    sizes = snapshot_sizes(ssh_user, ssh_ip, [s['path'] for s in by_use])
+
+    kept = []
+    removed = []
+    total = 0
+    for snapshot in by_use:
+        size = sizes.get(snapshot['path'])
+        if size is None:
+            # Removed by someone else
+            continue
+        fits = budget_mb is None or total + size <= budget_mb * 1024
+        if not kept or (len(kept) < keep and fits):
+            kept.append(snapshot)
+            total += size
+        else:
+            removed.append(snapshot)
+
+    if removed:
+        # The timestamp folders are removed once empty
+        paths = ' '.join(s['path'] for s in removed)
+        parents = ' '.join(os.path.dirname(s['path']) for s in removed)
+        command = append_ssh(
+            ssh_user, ssh_ip, "'rm -rf %s; rmdir %s 2>/dev/null; true'" % (paths, parents))
+        with trace.span('snapshot_gc', removed=len(removed)):
+            run_system_command(command)
+        freed = sum(sizes[s['path']] for s in removed)
+        print("Removed %d old snapshots, %.1f MB freed" % (len(removed), freed / 1024.))
+    print("Keeping %d snapshots, %.1f MB" % (len(kept), total / 1024.))
+
+    return sorted(kept, key=lambda s: s['last_used'])
+
+
+def send_snapshot(ssh_user, ssh_ip, proj_root, remote_folder, workspace, ignore=None,
+                  keep=KEEP_SNAPSHOTS, budget_mb=None, outputs=None):
+    """Send the project into a new timestamped folder, and drop old snapshots.
+
+    The new snapshot starts as a hardlinked copy of the last one, so
+    only the files that changed since are sent and take new disk.
+
+    Parameters
+    ----------
+    ssh_user : str
+        The user to ssh to
+    ssh_ip : str
+        Ip of the workstation
+    proj_root : str
+        The root of the project that is running
+    remote_folder : str
+        Folder the snapshots are made in (On remote location)
+    workspace : str
+        The stable project folder on the remote, keeps the snapshot list
+    ignore : IgnoreFilter, optional
+        Files in the project root to leave out
+    keep : int, optional
+        How many snapshots to keep at most
+    budget_mb : float, optional
+        How much disk the snapshots may take together
+    outputs : IgnoreFilter, optional
+        Files the runs make, see sync_project
+
+    Returns
+    -------
+    str
+        The folder the project was sent to
+    """
+    registry_path = _registry_path(workspace)
+    snapshots = read_remote_json(ssh_user, ssh_ip, registry_path) or []
+
+    tmp_build = time.strftime("%Y_%m_%d_%H%M%S")
+    tmp_path = os.path.join(remote_folder, tmp_build, os.path.basename(proj_root))
+
+    # Start from the last snapshot, unless it is gone
+    base = max(snapshots, key=lambda s: s['last_used'])['path'] if snapshots else None
+    if base is not None and base != tmp_path:
+        command = append_ssh(ssh_user, ssh_ip, "'mkdir -p %s && [ -d %s ] && cp -al %s %s; true'" % (
+            os.path.dirname(tmp_path), base, base, tmp_path))
+        with trace.span('snapshot_link', base=base):
+            run_system_command(command)
+    remote_manifest = read_remote_manifest(ssh_user, ssh_ip, tmp_path)
+    if remote_manifest is None:
+        print("No previous snapshot to start from, sending the whole project")
+    sync_project(ssh_user, ssh_ip, proj_root, tmp_path, remote_manifest, ignore=ignore,
+                 outputs=outputs)
+
+    now = time.time()
+    snapshots = [s for s in snapshots if s['path'] != tmp_path]
+    snapshots.append({'path': tmp_path, 'created': now, 'last_used': now})
+    snapshots = collect_garbage(ssh_user, ssh_ip, snapshots, keep=keep, budget_mb=budget_mb)
+    write_remote_json(ssh_user, ssh_ip, registry_path, snapshots)
+
+    return tmp_path
@@ -1,8 +1,103 @@
-import zipfile
 import subprocess
-import time
+import tempfile
+import json
 import os
+import shlex
 import getpass
+import threading
+
+from . import ignore as ig
+from . import manifest as mf
+from . import trace
+from .config import is_remote, positive_setting
+
+# Where the master connections keep their sockets, expanded by ssh. %u,
+# the local user, keeps users of one machine apart, %C hashes the host,
+# port and remote user so the path stays short enough for a socket
+CONTROL_PATH = os.path.join(tempfile.gettempdir(), 'bwd-ssh-%u-%C')
+# Seconds an idle master connection is kept alive, so the next run can reuse it
+CONTROL_PERSIST = 600
+# Warn when the remote has less free disk than this (MB)
+LOW_DISK_MB = 1024
+
+
+class SSHConnection():
+    """A master ssh connection that every command to a host goes through."""
+    def __init__(self, ssh_user, ssh_ip):
+        """Initialize class
+
+        Parameters
+        ----------
+        ssh_user : str
+            The user to ssh to
+        ssh_ip : str
+            Ip of the workstation
+
+        """
+        self._target = "%s@%s" % (ssh_user, ssh_ip)
+        self._options = "-o ControlMaster=no -o ControlPath='%s'" % CONTROL_PATH
+        self._is_open = False
+        # Stages of a pipeline may open the connection at the same time
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.commands = 0
+
+    def is_open(self):
+        """Check if a master connection is running for this host."""
+        command = "ssh %s -O check %s" % (self._options, self._target)
+        return subprocess.call(
+            command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def open(self):
+        """Start the master connection, unless one is already running."""
+        with self._lock:
+            if self._is_open:
+                return
+            if not self.is_open():
+                command = "ssh -M -N -f -o ControlPath='%s' -o ControlPersist=%d %s" \
+                    % (CONTROL_PATH, CONTROL_PERSIST, self._target)
+                # Not streamed, the master keeps running in the background
+                with trace.span('ssh_connect', host=self._target):
+                    subprocess.check_call(command, shell=True, stdout=subprocess.DEVNULL)
+                self.handshakes += 1
+            self._is_open = True
+
+    def close(self):
+        """Stop the master connection."""
+        command = "ssh %s -O exit %s" % (self._options, self._target)
+        subprocess.call(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._is_open = False
+
+    def command(self, cmd):
+        """Return cmd wrapped so it runs on the host through the master."""
+        self.open()
+        self.commands += 1
+        return "ssh %s %s %s" % (self._options, self._target, cmd)
+
+    def handshakes_avoided(self):
+        return max(self.commands - self.handshakes, 0)
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(ssh_user, ssh_ip):
+    """Return the one SSHConnection for (ssh_user, ssh_ip)."""
+    key = (ssh_user, ssh_ip)
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = SSHConnection(ssh_user, ssh_ip)
+        return _connections[key]
+
+
+def connection_report():
+    """Describe how the remote commands of this run used their connections."""
+    lines = []
+    for (ssh_user, ssh_ip), conn in sorted(_connections.items()):
+        lines.append("%s@%s: %d commands, %d handshakes, %d handshakes avoided" % (
+            ssh_user, ssh_ip, conn.commands, conn.handshakes, conn.handshakes_avoided()))
+    return '\n'.join(lines)
 
 
 def zipdir(path, zip_path, ignore_paths=None):
@@ -17,6 +112,8 @@ def zipdir(path, zip_path, ignore_paths=None):
     ignore_paths : None, optional
         List of folders to ignore
     """
+    import zipfile
+
     # Create ziph
     zipf = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
 
@@ -40,8 +137,12 @@ def zipdir(path, zip_path, ignore_paths=None):
     zipf.close()
 
 
-def zip_send_and_unzip(ssh_user, ssh_ip, proj_root, remote_folder, ignore_paths=None):
-    """Zip the project, send it and unzip at remote location.
+def stream_files(ssh_user, ssh_ip, proj_root, files, remote_dir):
+    """Stream some of the project files as a tar and extract them at remote_dir.
+
+    The archive is written straight into the ssh pipe, so nothing is
+    stored on local disk and compression overlaps with the transfer.
+    Large transfers are compressed by a process pool, see archive.
 
     Parameters
     ----------
@@ -51,38 +152,197 @@ def zip_send_and_unzip(ssh_user, ssh_ip, proj_root, remote_folder, ignore_paths=
         Ip of the workstation
     proj_root : str
         The root of the project that is running
-    remote_folder : str
-        Folder path to create (On remote location)
-    ignore_paths : None, optional
-        Paths to ignore in project root
+    files : list
+        Paths, relative to proj_root, to send
+    remote_dir : str
+        Folder to extract to (On remote location), it is created if
+        needed and existing files are replaced, never written in place,
+        so their hardlinks in snapshots keep the old content
     """
-    # Zip the file
-    tmp_build = time.strftime("%Y_%m_%d_%H%M%S")
-    zip_path = os.path.join(proj_root, "%s.zip" % tmp_build)
-    zipdir(proj_root, zip_path, ignore_paths=ignore_paths)
-
-    # Create the zip folder on receiving end
-    remote_zip_folder = os.path.join(remote_folder, 'zip_files')
-    command = "ssh %s@%s mkdir -p %s" % (ssh_user, ssh_ip, remote_zip_folder)
-    run_system_command(command)
+    command = append_ssh(
+        ssh_user, ssh_ip,
+        "'mkdir -p %s && tar --unlink-first -xzf - -C %s'" % (remote_dir, remote_dir))
+    from .archive import iter_tar_gz
+    with trace.span('transfer', files=len(files)):
+        run_system_command(command, stdin=trace.counted(iter_tar_gz(proj_root, files)))
 
-    # Send the zip file
-    command = "scp %s %s@%s:%s" % (zip_path, ssh_user, ssh_ip, remote_zip_folder)
-    run_system_command(command)
 
-    # Delete the local zipfile
-    command = "rm %s" % zip_path
+def relay_files(seed_user, seed_ip, ssh_user, ssh_ip, files, remote_dir):
+    """Have a seed host send files of its remote_dir to the same folder on another host.
+
+    The files travel between the two hosts, so they leave this machine
+    only once however many hosts relay them. The seed must be able to
+    ssh to the other host without a password.
+
+    Parameters
+    ----------
+    seed_user : str
+        The user to ssh to on the seed host
+    seed_ip : str
+        Ip of the seed host, which has the files in remote_dir
+    ssh_user : str
+        The user the seed host connects as
+    ssh_ip : str
+        Ip of the host to send to, as seen from the seed host
+    files : list
+        Paths, relative to remote_dir, to send
+    remote_dir : str
+        Folder to copy from on the seed, and to extract to on the host
+    """
+    extract = "mkdir -p %s && tar --unlink-first -xzf - -C %s" % (remote_dir, remote_dir)
+    relay = "cd %s && tar --null -czf - -T - | ssh -o BatchMode=yes %s@%s \"%s\"" % (
+        remote_dir, ssh_user, ssh_ip, extract)
+    command = append_ssh(seed_user, seed_ip, "'%s'" % relay)
+    with trace.span('relay', files=len(files), seed=seed_ip):
+        run_system_command(command, stdin=['\0'.join(files).encode()])
+
+
+def remove_remote_files(ssh_user, ssh_ip, files, remote_dir):
+    """Delete files, relative to remote_dir, on the remote host."""
+    command = append_ssh(ssh_user, ssh_ip, "'cd %s && xargs -0 rm -f --'" % remote_dir)
+    with trace.span('remote_delete', files=len(files)):
+        run_system_command(command, stdin=['\0'.join(files).encode()])
+
+
+def pull_missing_images(ssh_user, ssh_ip, images):
+    """Pull the images the remote docker daemon does not have yet.
+
+    A pull that fails is left for the docker build to report. The probes
+    forget the images, so the build fingerprint gets their new ids.
+    """
+    from .probe import forget_image
+    if not images:
+        return
+    script = '; '.join(
+        "docker image inspect %s >/dev/null 2>&1 || docker pull %s || true" % (
+            shlex.quote(image), shlex.quote(image)) for image in images)
+    command = append_ssh(ssh_user, ssh_ip, shlex.quote(script))
     run_system_command(command)
+    for image in images:
+        forget_image(ssh_user, ssh_ip, image)
+
+
+def read_remote_json(ssh_user, ssh_ip, path):
+    """Fetch a json file from the remote host, None if there is none."""
+    command = append_ssh(ssh_user, ssh_ip, "cat %s" % path)
+    try:
+        response = subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
+    try:
+        return json.loads(response.decode())
+    except ValueError:
+        return None
+
 
-    # Unzip the file at remote location
-    tmp_path = os.path.join(remote_folder, tmp_build, os.path.basename(proj_root))
-    remote_zip = os.path.join(remote_zip_folder, "%s.zip" % tmp_build)
-    create_cmd = "ssh %s@%s mkdir -p %s" % (ssh_user, ssh_ip, tmp_path)
-    unzip_cmd = "ssh %s@%s unzip %s -d %s" % (ssh_user, ssh_ip, remote_zip, tmp_path)
-    run_system_command(create_cmd)
-    run_system_command(unzip_cmd)
+def write_remote_json(ssh_user, ssh_ip, path, content):
+    """Store content as a json file on the remote host.
+
+    The file is replaced, not written in place, see stream_files.
+    """
+    folder = os.path.dirname(path)
+    command = append_ssh(
+        ssh_user, ssh_ip, "'mkdir -p %s && cat > %s.tmp && mv %s.tmp %s'" % (folder, path, path, path))
+    run_system_command(command, stdin=[json.dumps(content).encode()])
+
+
+def read_remote_manifest(ssh_user, ssh_ip, workspace):
+    """Fetch the manifest of a remote workspace, None if there is none."""
+    path = os.path.join(workspace, mf.STATE_DIR, mf.MANIFEST_NAME)
+    return read_remote_json(ssh_user, ssh_ip, path)
 
-    return tmp_path
+
+def write_remote_manifest(ssh_user, ssh_ip, workspace, manifest):
+    """Store the manifest of what is now in the remote workspace."""
+    path = os.path.join(workspace, mf.STATE_DIR, mf.MANIFEST_NAME)
+    write_remote_json(ssh_user, ssh_ip, path, manifest)
+
+
+def update_local_manifest(proj_root, ignore=None):
+    """Make the manifest of the project as it is now, and keep it for next time.
+
+    Hashes of unchanged files are reused from the last local manifest.
+    """
+    manifest_path = mf.local_manifest_path(proj_root)
+    with trace.span('manifest') as span:
+        local_manifest = mf.build_manifest(
+            proj_root, previous=mf.load_manifest(manifest_path), ignore=ignore)
+        mf.save_manifest(manifest_path, local_manifest)
+        span.add(files=len(local_manifest))
+    return local_manifest
+
+
+def sync_project(ssh_user, ssh_ip, proj_root, workspace, remote_manifest=None, ignore=None,
+                 relay_from=None, local_manifest=None, outputs=None):
+    """Update a remote workspace in place so it matches the project.
+
+    Only files that were added or changed since remote_manifest was
+    written are sent, files that no longer exist are deleted.
+
+    Parameters
+    ----------
+    ssh_user : str
+        The user to ssh to
+    ssh_ip : str
+        Ip of the workstation
+    proj_root : str
+        The root of the project that is running
+    workspace : str
+        The stable project folder on the remote location
+    remote_manifest : dict, optional
+        Manifest of the current workspace content, None sends everything
+    ignore : IgnoreFilter, optional
+        Files to leave out, ones that were synced before are deleted
+    relay_from : tuple, optional
+        (ssh_user, ssh_ip) of a host whose workspace is already synced,
+        it sends the changed files instead of this machine, see relay_files
+    local_manifest : dict, optional
+        Manifest of the project, made with update_local_manifest if not given
+    outputs : IgnoreFilter, optional
+        Files the runs make, they come from the remote, see outputs.py,
+        and are neither sent nor removed there
+
+    Returns
+    -------
+    str
+        The workspace
+    """
+    remote_manifest = remote_manifest or {}
+    if local_manifest is None:
+        local_manifest = update_local_manifest(proj_root, ignore=ignore)
+
+    changed, removed = mf.diff_manifests(remote_manifest, local_manifest)
+    if outputs is not None:
+        changed = [path for path in changed if not outputs.is_ignored(path)]
+        removed = [path for path in removed if not outputs.is_ignored(path)]
+    trace.add(changed=len(changed), removed=len(removed))
+    print("Syncing %s: %d changed, %d removed, %d unchanged" % (
+        workspace, len(changed), len(removed), len(local_manifest) - len(changed)))
+
+    if changed and relay_from is not None:
+        relay_files(relay_from[0], relay_from[1], ssh_user, ssh_ip, changed, workspace)
+    elif changed:
+        stream_files(ssh_user, ssh_ip, proj_root, changed, workspace)
+    if removed:
+        remove_remote_files(ssh_user, ssh_ip, removed, workspace)
+
+    write_remote_manifest(ssh_user, ssh_ip, workspace, local_manifest)
+
+    # A probe of the workspace may have run during the sync
+    from .probe import synced
+    synced(ssh_user, ssh_ip, workspace, local_manifest)
+
+    return workspace
+
+
+def get_workspace(proj_root, remote_folder):
+    """Return the stable folder of the project on the remote host."""
+    # Append the user to the remote dir
+    return os.path.join(
+        remote_folder,
+        getpass.getuser(),
+        os.path.basename(proj_root)
+    )
 
 
 def create_remote_dir(ssh_user, ssh_ip, proj_root, remote_folder):
@@ -104,65 +364,176 @@ def create_remote_dir(ssh_user, ssh_ip, proj_root, remote_folder):
     TYPE
         Description
     """
-    # Append the user to the remote dir
-    remote_folder = os.path.join(
-        remote_folder,
-        getpass.getuser(),
-        os.path.basename(proj_root)
-    )
-    cmd = "ssh %s@%s mkdir -p %s" % (ssh_user, ssh_ip, remote_folder)
-    run_system_command(cmd)
+    remote_folder = get_workspace(proj_root, remote_folder)
+    cmd = append_ssh(ssh_user, ssh_ip, "mkdir -p %s" % remote_folder)
+    with trace.span('create_remote_dir'):
+        run_system_command(cmd)
 
     return remote_folder
 
 
-def run_system_command(command):
-    """Run command in a shell process."""
-    result = subprocess.check_output(command, shell=True)
-    return result
+def run_system_command(command, stdin=None):
+    """Run command, streaming its output, see utils.run_and_stream."""
+    from .utils import run_and_stream
+    return run_and_stream(command, stdin=stdin, prefix='[remote] ')
+
+
+def check_remote_state(state, args):
+    """Warn about a remote that is low on disk, or lacks the GPUs of args."""
+    if state.disk_free_kb is not None and state.disk_free_kb < LOW_DISK_MB * 1024:
+        print("Warning, only %.1f MB free in %s on %s" % (
+            state.disk_free_kb / 1024., args.remote_folder, args.ssh_ip))
+    if args.gpu and state.gpus:
+        indices = set(gpu['index'] for gpu in state.gpus)
+        missing = [gpu for gpu in args.gpu if gpu not in indices]
+        if missing:
+            print("Warning, %s has no GPU %s, it has %s" % (
+                args.ssh_ip, ', '.join(str(g) for g in missing),
+                ', '.join(str(i) for i in sorted(indices))))
+
+
+def send_pipeline(args, relay_from=None, on_synced=None):
+    """Return the stages that send the project to the remote and build it.
+
+    Stages that do not need each other run at the same time, e.g. the
+    workspace is made and its manifest read while the local manifest
+    is hashed, the remote is probed and the base images pulled while
+    the files are sent, and a shipped image is built during the sync.
+
+    Parameters
+    ----------
+    args : argparse
+        Parsed argparse dict from bwd.py
+    relay_from : tuple, optional
+        (ssh_user, ssh_ip) of a synced host to relay the files from,
+        only used by the delta sync, see sync_project
+    on_synced : callable, optional
+        Called once the project is on the remote
+
+    Returns
+    -------
+    Pipeline
+        The result of its 'sync' stage is the folder the project was sent to
+    """
+    from .pipeline import Pipeline
+    from .probe import probe
+    from .deps import from_args
+    from .docker_images import DockerImages
+    from .outputs import get_filter
+    ssh_user, ssh_ip = args.ssh_user, args.ssh_ip
+    # Files the runs make stay on the remote until they are fetched
+    outputs = get_filter(args.outputs)
+    pipe = Pipeline()
+
+    # Files matched by .bwdignore / .dockerignore (/ .gitignore) stay local
+    pipe.add('ignore', lambda r: ig.load_ignore(args.proj, use_gitignore=args.use_gitignore))
+    pipe.add('workspace', lambda r: create_remote_dir(
+        ssh_user, ssh_ip, args.proj, args.remote_folder))
+
+    # Send it over. Unless a new snapshot is asked for, the workspace
+    # is updated in place, sending only what changed since last time.
+    if args.sync == 'snapshot':
+        from .snapshots import send_snapshot, KEEP_SNAPSHOTS
+        keep = positive_setting(args, 'snapshot_keep', KEEP_SNAPSHOTS)
+
+        # Old snapshots are removed, the rest share unchanged files
+        def sync(r):
+            remote_folder = send_snapshot(
+                ssh_user, ssh_ip, args.proj, args.remote_folder, r['workspace'],
+                ignore=r['ignore'], keep=keep,
+                budget_mb=args.snapshot_budget_mb,
+                outputs=outputs)
+            if on_synced is not None:
+                on_synced()
+            return remote_folder
+        pipe.add('sync', sync, needs=('workspace', 'ignore'))
+        probe_needs = ('sync',)
+    else:
+        def sync(r):
+            if r['remote_manifest'] is None:
+                print("No previous snapshot on remote, sending the whole project")
+            remote_folder = sync_project(
+                ssh_user, ssh_ip, args.proj, r['workspace'], r['remote_manifest'],
+                ignore=r['ignore'], relay_from=relay_from, local_manifest=r['local_manifest'],
+                outputs=outputs)
+            if on_synced is not None:
+                on_synced()
+            return remote_folder
+        pipe.add('remote_manifest', lambda r: read_remote_manifest(
+            ssh_user, ssh_ip, get_workspace(args.proj, args.remote_folder)))
+        pipe.add('local_manifest', lambda r: update_local_manifest(
+            args.proj, ignore=r['ignore']), needs=('ignore',))
+        pipe.add('sync', sync, needs=('workspace', 'remote_manifest', 'local_manifest'))
+        # The workspace stays where it is, it can be probed during the sync
+        probe_needs = ('workspace',)
 
+    # One round trip tells the Dockerfiles, images, disk and GPUs of
+    # the remote, the listings and image lookups of the build use it
+    def probe_remote(r):
+        remote_folder = r['sync'] if 'sync' in probe_needs else r['workspace']
+        state = probe(remote_folder, ssh_user, ssh_ip, disk_dir=r['workspace'])
+        check_remote_state(state, args)
+        return state
+    pipe.add('probe', probe_remote, needs=probe_needs)
 
-def maybe_send(args):
+    if args.ship_image:
+        # Build here and send the image, the remote gets only the
+        # layers it does not have
+        def local_build(r):
+            img = DockerImages(args.proj, ignore=r['ignore'], use_cache=args.build_cache,
+                               deps=from_args(args, remote=False))
+            img.build_one(args.d)
+            return img.get_image_name(args.d)
+
+        def ship(r):
+            from .ship import ship_image
+            ship_image(r['local_build'], ssh_user, ssh_ip)
+        pipe.add('local_build', local_build, needs=('ignore',))
+        pipe.add('ship', ship, needs=('local_build', 'probe'))
+    else:
+        # Base images the remote lacks are pulled while the files are sent
+        def pull_base(r):
+            img = DockerImages(args.proj, ignore=r['ignore'], use_cache=False)
+            pull_missing_images(ssh_user, ssh_ip, img.get_base_images(args.d))
+
+        # Build on remote, unless the image is up to date. The build cache
+        # lives in the stable workspace, so snapshots share it.
+        def remote_build(r):
+            img = DockerImages(
+                r['sync'], ssh_user, ssh_ip, ignore=r['ignore'],
+                source_dir=args.proj, cache_dir=os.path.join(r['workspace'], mf.STATE_DIR),
+                use_cache=args.build_cache, deps=from_args(args, remote=True))
+            img.build_one(args.d)
+        pipe.add('pull_base', pull_base, needs=('ignore',))
+        pipe.add('remote_build', remote_build, needs=('sync', 'probe', 'pull_base'))
+
+    return pipe
+
+
+def maybe_send(args, relay_from=None, on_synced=None):
     """Check the values of args and send the project if desired.
 
     Parameters
     ----------
     args : argparse
         Parsed argparse dict from bwd.py
+    relay_from : tuple, optional
+        (ssh_user, ssh_ip) of a synced host to relay the files from,
+        only used by the delta sync, see sync_project
+    on_synced : callable, optional
+        Called once the project is on the remote
 
     """
-    check_list = [
-        'ssh_ip',
-        'ssh_user',
-        'remote_folder'
-    ]
-
-    for item in check_list:
-        if getattr(args, item) is None:
-            return None
-
-    # Begin by creating the end remote folder
-    create_remote_dir(
-        args.ssh_user,
-        args.ssh_ip,
-        args.proj,
-        args.remote_folder)
-
-    # Send it over
-    remote_folder = zip_send_and_unzip(
-        args.ssh_user,
-        args.ssh_ip,
-        args.proj,
-        args.remote_folder,
-        ignore_paths=None)
-
-    # If on remote, always rebuild
-    from .docker_classes import DockerImages
-    img = DockerImages(remote_folder, args.ssh_user, args.ssh_ip)
-    img.build_one(args.d)
+    if not is_remote(args):
+        return None
 
-    return remote_folder
+    from .utils import get_prefix
+    pipe = send_pipeline(args, relay_from=relay_from, on_synced=on_synced)
+    results = pipe.run()
+    trace.add(critical_path=' > '.join(pipe.critical_path()))
+    print("%s%s" % (get_prefix(), pipe.report()))
+    return results['sync']
 
 
 def append_ssh(ssh_user, ssh_ip, command):
-    return "ssh %s@%s %s" % (ssh_user, ssh_ip, command)
\ No newline at end of file
+    return get_connection(ssh_user, ssh_ip).command(command)
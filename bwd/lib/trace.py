@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+class Span():
+    """One timed phase of a run."""
+    def __init__(self, name, parent, args):
+        self.name = name
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.args = args
+        self.thread = threading.get_ident()
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def add(self, **kwargs):
+        """Add numbers to the span, e.g. bytes=..., they are summed up."""
+        for key, value in kwargs.items():
+            if isinstance(value, (int, float)) and isinstance(self.args.get(key), (int, float)):
+                self.args[key] += value
+            else:
+                self.args[key] = value
+
+
+class Tracer():
+    """Collects the spans of a run, from any thread."""
+    def __init__(self):
+        self.spans = []
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        stack = self._stack()
+        span = Span(name, stack[-1] if stack else None, args)
+        self.spans.append(span)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = time.time()
+            stack.pop()
+
+    def current(self):
+        """The innermost open span of this thread, None outside of spans."""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def summary(self):
+        """A table of every span, each under the span it ran in."""
+        if not self.spans:
+            return "No phases were recorded"
+        children = {}
+        for span in sorted(self.spans, key=lambda s: s.start):
+            children.setdefault(id(span.parent) if span.parent else None, []).append(span)
+
+        lines = ["%-40s %10s  %s" % ('Phase', 'Seconds', 'Details')]
+        stack = list(reversed(children.get(None, [])))
+        while stack:
+            span = stack.pop()
+            stack.extend(reversed(children.get(id(span), [])))
+            details = ', '.join('%s=%s' % item for item in sorted(span.args.items()))
+            lines.append("%-40s %10.3f  %s" % (
+                '  ' * span.depth + span.name, span.duration, details))
+        return '\n'.join(lines)
+
+    def to_chrome_trace(self):
+        """The spans in the Chrome trace event format, for chrome://tracing."""
+        threads = {}
+        events = []
+        for span in self.spans:
+            tid = threads.setdefault(span.thread, len(threads))
+            events.append({
+                'name': span.name,
+                'ph': 'X',
+                'ts': span.start * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': span.args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f, default=str)
+
+
+# The tracer of this process
+_tracer = Tracer()
+
+
+def span(name, **args):
+    """Time a phase, use as ``with trace.span('sync', files=10) as s:``."""
+    return _tracer.span(name, **args)
+
+
+def add(**kwargs):
+    """Add details to the innermost open span, if there is one."""
+    current = _tracer.current()
+    if current is not None:
+        current.add(**kwargs)
+
+
+def counted(parts, key='bytes'):
+    """Pass chunks of bytes through, adding their size to the current span.
+
+    The span is the one open when counted is called, so the chunks can
+    be consumed later or from another thread.
+    """
+    current = _tracer.current()
+    if current is None:
+        return parts
+    current.add(**{key: 0})
+
+    def count():
+        for part in parts:
+            current.add(**{key: len(part)})
+            yield part
+    return count()
+
+
+@contextlib.contextmanager
+def inside(parent):
+    """Nest the spans of this thread under parent, a span of another thread."""
+    if parent is None:
+        yield
+        return
+    stack = _tracer._stack()
+    stack.append(parent)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def get_tracer():
+    return _tracer
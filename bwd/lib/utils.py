@@ -1,10 +1,14 @@
 import os
-import subprocess
+import shlex
+import threading
+import collections
+import contextlib
+import functools
 import sys
 
 
 from . import custom_exceptions as ce
-from .ssh_utils import append_ssh
+from . import trace
 
 def remove_docker_cmd(cmd, args, remote_folder):
     """Removes cmd related to docker."""
@@ -26,26 +30,133 @@ def remove_docker_cmd(cmd, args, remote_folder):
     return cmd
 
 
-def run_and_stream(cmd, debug=False):
+# Lines of output kept for error reports
+TAIL_LINES = 50
+# Longer lines are forwarded in pieces
+MAX_LINE = 64 * 1024
+
+# Lines of commands running at the same time are printed one at a time
+_print_lock = threading.Lock()
+# Holds the output prefix of each thread, see prefixed
+_local = threading.local()
+
+
+def get_prefix():
+    """The output prefix of this thread, see prefixed."""
+    return getattr(_local, 'prefix', '')
+
+
+@contextlib.contextmanager
+def prefixed(prefix):
+    """Put prefix in front of the output of every command this thread streams."""
+    previous = get_prefix()
+    _local.prefix = previous + prefix
+    try:
+        yield
+    finally:
+        _local.prefix = previous
+
+
+def in_caller_context(func):
+    """Wrap func to run under the open span and output prefix of the caller.
+
+    Work handed to another thread shows up in the trace and the output
+    as if it ran in the thread that handed it over.
+    """
+    parent = trace.get_tracer().current()
+    prefix = get_prefix()
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        with trace.inside(parent), prefixed(prefix):
+            return func(*args, **kwargs)
+    return wrapped
+
+
+def _forward_lines(stream, prefix, tail):
+    """Print every line of stream as it arrives, keep the last ones in tail."""
+    for raw in iter(lambda: stream.readline(MAX_LINE), b''):
+        line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+        tail.append(line)
+        with _print_lock:
+            sys.stdout.write("%s%s\n" % (prefix, line))
+            sys.stdout.flush()
+
+
+def run_and_stream(cmd, debug=False, stdin=None, prefix='', tail_lines=TAIL_LINES):
     """Run a shell command and stream output
 
+    Output, stdout and stderr together, is printed line by line while
+    the command runs. Only the last tail_lines lines are kept in memory.
+
     Parameters
     ----------
     cmd : str
-        Shell command to run
+        Shell command to run, split into arguments as a shell would
     debug : bool, optional
         Print command and response
+    stdin : iterable, optional
+        Chunks of bytes to feed the command on stdin
+    prefix : str, optional
+        Put in front of every printed line, to tell apart the output
+        of commands that run at the same time. Comes after the prefix
+        of the thread, see prefixed
+    tail_lines : int, optional
+        How many of the last lines to keep
 
     Returns
     -------
     str
-        Raw response from terminal
+        The last tail_lines lines of output
+
+    Raises
+    ------
+    ce.CommandFailed
+        The command exited with an error, the exception has the tail
     """
-    if debug:
-        print("Running: %s" % cmd)
-    response = subprocess.check_output(cmd.split(' '))
+    import subprocess
 
-    return response
+    prefix = get_prefix() + prefix
+    if debug:
+        print("%sRunning: %s" % (prefix, cmd))
+
+    proc = subprocess.Popen(
+        shlex.split(cmd),
+        stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+
+    # Feed stdin from a thread, so a full stdout pipe can not block it
+    feed_errors = []
+
+    def feed():
+        try:
+            for chunk in stdin:
+                proc.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            proc.stdin.close()
+
+    feeder = None
+    if stdin is not None:
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+    tail = collections.deque(maxlen=tail_lines)
+    _forward_lines(proc.stdout, prefix, tail)
+    proc.stdout.close()
+    if feeder is not None:
+        feeder.join()
+    if feed_errors:
+        proc.wait()
+        raise feed_errors[0]
+    if proc.wait() != 0:
+        raise ce.CommandFailed(proc.returncode, cmd, list(tail))
+
+    return '\n'.join(tail)
 
 
 def run_command(cmd, debug=False):
@@ -76,7 +187,8 @@ def listdir(directory, ssh_user=None, ssh_ip=None):
     if ssh_ip is None:
         return os.listdir(directory)
     else:
-        return run_command("ssh %s@%s ls %s" % (ssh_user, ssh_ip, directory)).split('\n')
+        from .ssh_utils import append_ssh
+        return run_command(append_ssh(ssh_user, ssh_ip, "ls %s" % directory)).splitlines()
 
 
 def get_as_list(parameter):
@@ -108,15 +220,19 @@ def has_dockerfiles_folder(project_dir, ssh_user=None, ssh_ip=None):
     ce.DockerFolderMissing
         Description
     """
-    all_folders = listdir(project_dir, ssh_user, ssh_ip)
     docker_folder = os.path.join(project_dir, 'Dockerfiles')
-    if 'Dockerfiles' not in all_folders:
+    if ssh_ip is not None:
+        from .probe import probe
+        found = probe(project_dir, ssh_user, ssh_ip).dockerfiles is not None
+    else:
+        found = 'Dockerfiles' in os.listdir(project_dir)
+    if not found:
         raise ce.DockerFolderMissing()
     return docker_folder
 
 
-def get_docker_build_commands(project_dir, ssh_user=None, ssh_ip=None):
-    """Generate docker build commands for the project.
+def get_dockerfiles(project_dir, ssh_user=None, ssh_ip=None):
+    """Find the Dockerfiles of the project.
 
     Parameters
     ----------
@@ -131,40 +247,79 @@ def get_docker_build_commands(project_dir, ssh_user=None, ssh_ip=None):
     -------
     dict
         Dictionary where the key is the name of the docker-file
-        and the value is the corresponding build command
+        and the value is its full path
 
     Raises
     ------
     ce.DockerFilesMissing
         Description
-
     """
-
     # Make sure the path exsits
     docker_folder = has_dockerfiles_folder(project_dir, ssh_user, ssh_ip)
 
-    # Get all docker files here
-    all_files = listdir(docker_folder, ssh_user, ssh_ip)
+    # Get all docker files here, a remote listing comes from the probe
+    if ssh_ip is not None:
+        from .probe import probe
+        all_files = sorted(probe(project_dir, ssh_user, ssh_ip).dockerfiles)
+    else:
+        all_files = listdir(docker_folder)
 
     if len(all_files) == 0:
         raise ce.DockerFilesMissing()
 
+    return {
+        i_file.replace('.Dockerfile', ''): os.path.join(docker_folder, i_file)
+        for i_file in all_files}
+
+
+def get_docker_build_commands(project_dir, ssh_user=None, ssh_ip=None, dockerfiles=None):
+    """Generate docker build commands for the project.
+
+    Builds read their build context from stdin, so only the files the
+    Dockerfile needs are sent to the docker daemon, see DockerImages.
+    Local builds get the context as a tar. Remote builds get the list
+    of its files, the tar is made there from the synced workspace.
+
+    Parameters
+    ----------
+    project_dir : str
+        Full path to the project directory
+    ssh_user : None, optional
+        User name of the remote-host machine
+    ssh_ip : None, optional
+        IP address of the remote-host machine
+    dockerfiles : dict, optional
+        Output of get_dockerfiles, it is looked up if not given
+
+    Returns
+    -------
+    dict
+        Dictionary where the key is the name of the docker-file
+        and the value is the corresponding build command
+
+    Raises
+    ------
+    ce.DockerFilesMissing
+        Description
+
+    """
+    if dockerfiles is None:
+        dockerfiles = get_dockerfiles(project_dir, ssh_user, ssh_ip)
+    if ssh_user is not None:
+        from .ssh_utils import append_ssh
+
     # Create the command
     project_name = os.path.basename(project_dir)
-    all_cmd = []
-    all_images = []
-    for i_file in all_files:
-        docker_tag = i_file.replace('.Dockerfile', '')
-        full_path = os.path.join(docker_folder, i_file)
-        cmd = "docker build -t %s:%s -f %s %s" \
-            % (project_name, docker_tag, full_path, project_dir)
-
+    all_cmd = {}
+    for docker_tag, full_path in dockerfiles.items():
+        cmd = "docker build -t %s:%s -f %s -" \
+            % (project_name, docker_tag, os.path.relpath(full_path, project_dir))
         if ssh_user is not None:
-            cmd = append_ssh(ssh_user, ssh_ip, cmd)
-        all_cmd.append(cmd)
-        all_images.append(docker_tag)
+            cmd = append_ssh(
+                ssh_user, ssh_ip, "'cd %s && tar --null -cf - -T - | %s'" % (project_dir, cmd))
+        all_cmd[docker_tag] = cmd
 
-    return dict(zip(all_images, all_cmd))
+    return all_cmd
 
 
 def get_module_path(project_dir, script_path):
@@ -217,7 +372,11 @@ def is_file_in_project(project, dockerfile, ssh_user=None, ssh_ip=None):
     """
     docker_folder = has_dockerfiles_folder(project, ssh_user, ssh_ip)
 
-    all_files = os.listdir(docker_folder)
+    if ssh_ip is not None:
+        from .probe import probe
+        all_files = list(probe(project, ssh_user, ssh_ip).dockerfiles)
+    else:
+        all_files = os.listdir(docker_folder)
     all_files = [file.split('.')[0] for file in all_files]
     dockerfile = dockerfile.replace('.Dockerfile', '')
 
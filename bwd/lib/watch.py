@@ -0,0 +1,227 @@
+import os
+import time
+import shlex
+import signal
+import subprocess
+
+from . import ignore as ig
+from . import manifest as mf
+from . import trace
+from . import utils
+from .outputs import get_filter
+from .pipeline import Pipeline
+
+# Seconds between two looks at the project
+POLL_SECONDS = 0.25
+# Changes are acted on once the project has been still for this long,
+# so files saved together give one rerun
+SETTLE_SECONDS = 0.2
+# Seconds a stopped run gets to exit before it is killed
+STOP_SECONDS = 5
+
+
+def scan(proj_root, ignore=None):
+    """Return the {relative path: (size, mtime)} of every project file."""
+    state = {}
+    for rel_path in mf.walk_project(proj_root, ignore=ignore):
+        try:
+            stat = os.stat(os.path.join(proj_root, rel_path))
+        except OSError:
+            # Removed while walking
+            continue
+        state[rel_path] = (stat.st_size, stat.st_mtime)
+    return state
+
+
+def changed_paths(old, new):
+    """Return the files added, changed or removed between two scans."""
+    return sorted(path for path in set(old) | set(new) if old.get(path) != new.get(path))
+
+
+def wait_for_changes(proj_root, before, ignore=None, on_poll=None,
+                     poll=POLL_SECONDS, settle=SETTLE_SECONDS):
+    """Wait until files of the project change, and then stop changing.
+
+    Parameters
+    ----------
+    proj_root : str
+        The root of the project
+    before : dict
+        The scan to compare with, see scan
+    ignore : IgnoreFilter, optional
+        Files whose changes do not count
+    on_poll : callable, optional
+        Called every time the project is looked at
+
+    Returns
+    -------
+    tuple
+        (scan, changed) the scan of the project now, and the files that
+        changed since before
+    """
+    while True:
+        time.sleep(poll)
+        if on_poll is not None:
+            on_poll()
+        now = scan(proj_root, ignore)
+        if now != before:
+            break
+
+    while True:
+        time.sleep(settle)
+        later = scan(proj_root, ignore)
+        if later == now:
+            return now, changed_paths(before, now)
+        now = later
+
+
+class Watcher():
+    """Reruns the script of a build setting every time the project changes."""
+    def __init__(self, args, ssh_result=None):
+        """Initialize class
+
+        Parameters
+        ----------
+        args : Namespace
+            The build setting, see config.get_build_setting
+        ssh_result : str, optional
+            The folder maybe_send sent the project to, None when
+            running locally
+
+        """
+        from .docker_classes import BuildWithDocker
+        from .fanout import get_run_command
+        self._args = args
+        self._ssh_result = ssh_result
+        self._ignore = ig.load_ignore(args.proj, use_gitignore=args.use_gitignore)
+        self._outputs = get_filter(args.outputs)
+        # Fetched outputs are not changes of the project
+        self._watch_ignore = ig.load_ignore(args.proj, use_gitignore=args.use_gitignore)
+        self._watch_ignore.add_patterns(args.outputs or [])
+        self._process = None
+
+        self._command = get_run_command(args, ssh_result)
+        self._stop = None
+        if not args.disable_docker:
+            bwd = BuildWithDocker(args.proj, ssh_result)
+            bwd.add_arguments(args)
+            self._stop = bwd.get_stop_command()
+            if ssh_result is not None:
+                from .ssh_utils import append_ssh
+                self._stop = append_ssh(args.ssh_user, args.ssh_ip, shlex.quote(self._stop))
+
+        # What the remote folder holds, changed files are sent on top of it
+        self._remote_manifest = None
+        if ssh_result is not None:
+            from .ssh_utils import read_remote_manifest
+            self._remote_manifest = read_remote_manifest(
+                args.ssh_user, args.ssh_ip, ssh_result) or {}
+
+    def start(self):
+        """Start the run, in a process group of its own."""
+        utils.set_color('GREEN')
+        print("Docker command:\n\t--> %s" % self._command)
+        utils.set_color('RESET')
+        self._process = subprocess.Popen(self._command, shell=True, preexec_fn=os.setpgrp)
+
+    def stop(self):
+        """Stop the run if it is still running, and its container."""
+        process, self._process = self._process, None
+        if process is None or process.poll() is not None:
+            return
+        if self._stop is not None:
+            subprocess.call(self._stop, shell=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(timeout=STOP_SECONDS)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        except OSError:
+            # The group exited on its own
+            process.wait()
+
+    def _report_exit(self):
+        """Tell, once, that the run ended before the next change."""
+        if self._process is not None and self._process.poll() is not None:
+            print("The run exited with code %d, waiting for changes" % self._process.returncode)
+            self._process = None
+
+    def _sync(self):
+        """Send the changed files to the remote folder of the run."""
+        from .ssh_utils import sync_project, update_local_manifest
+        args = self._args
+        local_manifest = update_local_manifest(args.proj, ignore=self._ignore)
+        sync_project(
+            args.ssh_user, args.ssh_ip, args.proj, self._ssh_result, self._remote_manifest,
+            ignore=self._ignore, local_manifest=local_manifest, outputs=self._outputs)
+        self._remote_manifest = local_manifest
+
+    def _build(self):
+        """Build the image again, where the run would get it from."""
+        from .deps import from_args
+        from .docker_images import DockerImages
+        from .ssh_utils import get_workspace
+        args = self._args
+        if self._ssh_result is None or args.ship_image:
+            img = DockerImages(args.proj, ignore=self._ignore, use_cache=args.build_cache,
+                               deps=from_args(args, remote=False))
+            img.build_one(args.d)
+            if self._ssh_result is not None:
+                from .ship import ship_image
+                ship_image(img.get_image_name(args.d), args.ssh_user, args.ssh_ip)
+            return
+
+        workspace = get_workspace(args.proj, args.remote_folder)
+        img = DockerImages(
+            self._ssh_result, args.ssh_user, args.ssh_ip, ignore=self._ignore,
+            source_dir=args.proj, cache_dir=os.path.join(workspace, mf.STATE_DIR),
+            use_cache=args.build_cache, deps=from_args(args, remote=True))
+        img.build_one(args.d)
+
+    def update(self, changed):
+        """Bring the run up to date with the changed files and restart it.
+
+        The old run is stopped while the files are sent. The image is
+        only built again if a file in the Dockerfiles folder, or one of
+        the "requirements", changed.
+        """
+        requirements = set(self._args.requirements or [])
+        rebuild = any(path.split(os.sep)[0] == 'Dockerfiles' or path in requirements
+                      for path in changed)
+        pipe = Pipeline()
+        pipe.add('stop', lambda r: self.stop())
+        needs = ()
+        if self._ssh_result is not None:
+            pipe.add('sync', lambda r: self._sync())
+            needs = ('sync',)
+        if rebuild:
+            pipe.add('build', lambda r: self._build(), needs=needs)
+        pipe.run()
+        self.start()
+
+    def run(self):
+        """Start the run, then rerun it on every change until Ctrl-C."""
+        state = scan(self._args.proj, self._watch_ignore)
+        self.start()
+        try:
+            while True:
+                print("Watching %s for changes, Ctrl-C to stop" % self._args.proj)
+                state, changed = wait_for_changes(
+                    self._args.proj, state, self._watch_ignore, on_poll=self._report_exit)
+                start = time.time()
+                print("%d files changed: %s" % (len(changed), ', '.join(changed[:5])
+                                                 + (', ..' if len(changed) > 5 else '')))
+                with trace.span('watch_update', files=len(changed)):
+                    try:
+                        self.update(changed)
+                    except Exception as e:
+                        # Keep watching, the next change may fix it
+                        print("Could not rerun: %s" % e)
+                        continue
+                print("Restarted in %.2fs" % (time.time() - start))
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        finally:
+            self.stop()
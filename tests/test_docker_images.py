@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from bwd.lib import custom_exceptions as ce
+from bwd.lib import docker_images as di
+
+# Fails the build of base.Dockerfile, builds everything else
+FAKE_DOCKER = """#!/bin/sh
+[ "$1" = image ] && exit 1
+if [ "$1" = build ]; then
+    cat > /dev/null
+    case "$*" in *base.Dockerfile*) exit 1;; esac
+fi
+exit 0
+"""
+
+
+class TestBuildOrdered(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='bwd-test-')
+        self.proj = os.path.join(self.root, 'proj')
+        os.makedirs(os.path.join(self.proj, 'Dockerfiles'))
+        for name, base in (('base', 'python:3.11-slim'), ('a', 'proj:base'), ('b', 'proj:base')):
+            with open(os.path.join(self.proj, 'Dockerfiles', '%s.Dockerfile' % name), 'w') as f:
+                f.write("FROM %s\nCOPY . /app\n" % base)
+
+        fake_bin = os.path.join(self.root, 'bin')
+        os.makedirs(fake_bin)
+        docker = os.path.join(fake_bin, 'docker')
+        with open(docker, 'w') as f:
+            f.write(FAKE_DOCKER)
+        os.chmod(docker, 0o755)
+        self.path = '%s%s%s' % (fake_bin, os.pathsep, os.environ.get('PATH', ''))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_failed_parent_skips_children(self):
+        with mock.patch.dict(os.environ, {'PATH': self.path}):
+            images = di.DockerImages(self.proj, use_cache=False)
+            results = images._build_with_deps(list(images._docker_build), 2)
+            self.assertEqual({name: status for name, (status, _) in results.items()},
+                             {'base': 'failed', 'a': 'skipped', 'b': 'skipped'})
+            with self.assertRaises(ce.BuildFailed):
+                images.build_all()
+
+
+if __name__ == '__main__':
+    unittest.main()